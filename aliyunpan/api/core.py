@@ -1,27 +1,34 @@
+import hashlib
+import io
 import sys
 import time
 from collections.abc import Iterable
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from functools import partial
 from pathlib import Path
-from threading import RLock
+from threading import RLock, Lock, Event, Semaphore
 from typing import List
 
 import requests
 import simplejson
 
 # from aliyunpan.api import ua
+from aliyunpan.api.download import RemoteFile
 from aliyunpan.api.req import *
+from aliyunpan.api.store import HashCache, UrlCache
 from aliyunpan.api.type import UserInfo, AlibumInfo, Share
 from aliyunpan.api.utils import *
 from aliyunpan.common import *
 from aliyunpan.exceptions import InvalidRefreshToken, AliyunpanException, AliyunpanCode, LoginFailed, \
     InvalidContentHash, UploadUrlExpired, UploadUrlFailedRefresh, PartNumberOverLimit, BadResponseCode, \
-    PartNotSequential, InvalidExpiration, FileShareNotAllowed, InvalidParentFileId
+    PartNotSequential, InvalidExpiration, FileShareNotAllowed, InvalidParentFileId, UploadTimeout, UploadCancelled
 
 __all__ = ['AliyunPan']
 
 
 class AliyunPan(object):
+    _illegal_url = 'https://pds-system-file.oss-cn-beijing.aliyuncs.com/illegal.mp4'
 
     def __init__(self, refresh_token: str = None, album: bool = False, share: Share = Share()):
         self._req = Req(self)
@@ -38,6 +45,15 @@ class AliyunPan(object):
         self._access_token_gen_ = self._access_token_gen()
         self._drive_id_gen_ = self._drive_id_gen()
         self._chunk_size = 524288
+        self._chunk_sizer = ChunkSizer(self._chunk_size)
+        # 全局上传限速，每个文件的限速以其为上级
+        self._upload_limiter = RateLimiter()
+        self._file_upload_rate = 0
+        self._url_cache = UrlCache()
+        # 获取到的转码播放链接，内容与原文件不同
+        self._fallback_url_set = set()
+        self._pre_hash_size = 1024
+        self._pre_hash_min_size = 10485760
         self._print = Printer()
         self._lock = RLock()
 
@@ -49,6 +65,11 @@ class AliyunPan(object):
                         lambda self, value: setattr(self, '_drive_id', value))
     album = property(lambda self: self._album, lambda self, value: setattr(self, '_album', value))
     share = property(lambda self: self._share)
+    url_cache = property(lambda self: self._url_cache, lambda self, value: setattr(self, '_url_cache', value))
+    upload_rate = property(lambda self: self._upload_limiter.rate,
+                           lambda self, value: setattr(self._upload_limiter, 'rate', parse_size(value)))
+    file_upload_rate = property(lambda self: self._file_upload_rate,
+                                lambda self, value: setattr(self, '_file_upload_rate', parse_size(value)))
 
     def login(self, username: str = None, password: str = None, ua: str = None):
         """
@@ -107,34 +128,48 @@ class AliyunPan(object):
         :param next_marker:
         :return:
         """
-        json = {"parent_file_id": parent_file_id}
-        if next_marker:
-            json['marker'] = next_marker
-        headers = {}
-        kwargs = {}
-        if self._share.share_id:
-            url = 'https://api.aliyundrive.com/adrive/v3/file/list'
-            json.update({'share_id': self._share.share_id, 'share_pwd': self._share.share_pwd})
-            headers = {'x-share-token': self.get_share_token()}
-            kwargs = {'access_token': None}
-        else:
-            url = 'https://api.aliyundrive.com/v2/file/list'
-            json.update({"drive_id": self.drive_id, 'fields': '*'})
-        logger.info(f'Get the list of parent_file_id {parent_file_id}.')
-        r = self._req.post(url, json=json, headers=headers, **kwargs)
-        try:
-            logger.debug(r.json())
-        except simplejson.errors.JSONDecodeError:
-            if retry:
-                return self.get_file_list(parent_file_id=parent_file_id, next_marker=next_marker, retry=retry - 1)
+        return list(self.iter_file_list(parent_file_id, next_marker=next_marker, retry=retry))
+
+    def iter_file_list(self, parent_file_id: str = 'root', limit: int = 100, next_marker: str = None, retry=3):
+        """
+        逐页获取文件列表，每页返回后立即产出
+        :param parent_file_id:
+        :param limit: 每页的文件数
+        :param next_marker: 从指定的marker开始
+        :param retry: 响应解析失败时的重试次数
+        :return: 文件信息的迭代器
+        """
+        while True:
+            json = {"parent_file_id": parent_file_id, 'limit': limit}
+            if next_marker:
+                json['marker'] = next_marker
+            headers = {}
+            kwargs = {}
+            if self._share.share_id:
+                url = 'https://api.aliyundrive.com/adrive/v3/file/list'
+                json.update({'share_id': self._share.share_id, 'share_pwd': self._share.share_pwd})
+                headers = {'x-share-token': self.get_share_token()}
+                kwargs = {'access_token': None}
             else:
-                raise
-        if 'items' not in r.json():
-            return []
-        file_list = r.json()['items']
-        if 'next_marker' in r.json() and r.json()['next_marker'] and next_marker != r.json()['next_marker']:
-            file_list.extend(self.get_file_list(parent_file_id, r.json()['next_marker']))
-        return file_list
+                url = 'https://api.aliyundrive.com/v2/file/list'
+                json.update({"drive_id": self.drive_id, 'fields': '*'})
+            logger.info(f'Get the list of parent_file_id {parent_file_id}.')
+            for retry_count in range(retry + 1):
+                r = self._req.post(url, json=json, headers=headers, **kwargs)
+                try:
+                    data = r.json()
+                    break
+                except simplejson.errors.JSONDecodeError:
+                    if retry_count >= retry:
+                        raise
+            logger.debug(data)
+            if 'items' not in data:
+                return
+            yield from data['items']
+            marker = data.get('next_marker')
+            if not marker or marker == next_marker:
+                return
+            next_marker = marker
 
     def delete_file(self, file_id: str):
         """
@@ -297,7 +332,8 @@ class AliyunPan(object):
 
     def upload_file(self, parent_file_id: str = 'root', path: str = None, upload_timeout: float = 10,
                     retry_num: int = 3, force: bool = False, chunk_size: int = None, c: bool = False,
-                    ignore: bool = False):
+                    ignore: bool = False, workers: int = 1, pre_hash: bool = False, stream_hash: bool = False,
+                    cancel_event: Event = None):
         """
         上传文件
         :param parent_file_id: 上传目录的id
@@ -308,37 +344,73 @@ class AliyunPan(object):
         :param chunk_size: 分块大小
         :param c: 断点续传
         :param ignore: 忽略上传失败的文件
+        :param workers: 并发上传的分块数
+        :param pre_hash: 先用文件前1KB的sha1预检能否秒传
+        :param stream_hash: 不尝试秒传，边上传边计算sha1
+        :param cancel_event: 多个文件共用的取消信号，设置后停止上传中的分块
         :return:
         """
         if not parent_file_id:
             raise InvalidParentFileId
         path = Path(path)
-        file_size = path.stat().st_size
-        file_name = path.name
-        self._chunk_size = chunk_size or self._chunk_size
-        # 获取sha1
         try:
-            content_hash = get_sha1(path, self._chunk_size)
+            f = path.open('rb')
         except PermissionError:
             if not ignore:
                 self._print.upload_info(path, status=False)
                 self._print.print_line()
             return False
+        with f:
+            try:
+                return self._upload_file(f, parent_file_id, path, upload_timeout, retry_num, force, chunk_size, c,
+                                         ignore, workers, pre_hash, stream_hash, cancel_event)
+            except UploadTimeout:
+                self._print.error_info(f'上传超时{retry_num}次，即将重新上传', refresh_line=True)
+        time.sleep(1)
+        return self.upload_file(parent_file_id=parent_file_id, path=path, upload_timeout=upload_timeout,
+                                retry_num=retry_num, force=force, chunk_size=chunk_size, c=c, ignore=ignore,
+                                workers=workers, pre_hash=pre_hash, stream_hash=stream_hash,
+                                cancel_event=cancel_event)
+
+    def _upload_file(self, f, parent_file_id: str, path: Path, upload_timeout: float, retry_num: int, force: bool,
+                     chunk_size: int, c: bool, ignore: bool, workers: int, pre_hash: bool, stream_hash: bool,
+                     cancel_event: Event = None):
+        """
+        上传已打开的文件，计算哈希和读取分块共用同一个文件描述符
+        """
+        stat = path.stat()
+        file_size = stat.st_size
+        file_name = path.name
+        # 未指定分块大小时，根据文件大小和之前分块的上传速度选择分块大小
+        auto_chunk_size = not chunk_size
+        chunk_size = chunk_size or self._chunk_sizer.get_chunk_size(file_size)
         while True:
             # 分片列表
             part_info_list = []
-            count = int(file_size / self._chunk_size) + 1
+            count = int(file_size / chunk_size) + 1
             for i in range(count):
                 part_info_list.append({"part_number": i + 1})
             if len(part_info_list) > 10000:
-                if chunk_size:
+                if not auto_chunk_size:
                     raise PartNumberOverLimit
-                self._chunk_size = int(file_size / 1000)
+                chunk_size = int(file_size / 1000)
                 continue
             break
-        proof_code = get_proof_code(get_file_byte(path, self.access_token))
+        workers = max(workers or 1, 1)
+        # 小文件计算sha1很快，不预检；边上传边计算sha1不限大小；已缓存sha1时直接尝试秒传
+        probe = pre_hash and file_size >= self._pre_hash_min_size
+        if (probe or stream_hash) and not HashCache().get(path, stat):
+            file_info = self._stream_upload(f, parent_file_id, path, stat, part_info_list, chunk_size,
+                                            upload_timeout, retry_num, force, c, ignore, workers, probe=probe,
+                                            cancel_event=cancel_event)
+            if file_info is not None:
+                return file_info
+        # 一次读取获取sha1和proof_code
+        content_hash, proof_bytes = get_file_hash(f, path, chunk_size,
+                                                  get_proof_range(file_size, self.access_token))
+        proof_code = get_proof_code(proof_bytes)
         json = {"size": file_size, "part_info_list": part_info_list, "content_hash": content_hash,
-                'proof_code': proof_code, 'proof_version': 'v1'}
+                'proof_code': proof_code, 'proof_version': 'v1', 'parallel_upload': workers > 1}
         path_list = []
         existed = False
         # 已存在任务
@@ -371,11 +443,14 @@ class AliyunPan(object):
         if c and content_hash in GLOBAL_VAR.tasks and not existed:
             upload_id = GLOBAL_VAR.tasks[content_hash].upload_id
             file_id = GLOBAL_VAR.tasks[content_hash].file_id
-            self._chunk_size = GLOBAL_VAR.tasks[content_hash].chunk_size
+            chunk_size = GLOBAL_VAR.tasks[content_hash].chunk_size
             part_number = GLOBAL_VAR.tasks[content_hash].part_number
+            if not GLOBAL_VAR.tasks[content_hash].parallel_upload:
+                # 顺序上传的任务只能继续顺序上传
+                workers = 1
             try:
                 # 获取上传链接列表
-                part_info_list = self.get_upload_url(path, upload_id, file_id, self._chunk_size, part_number)
+                part_info_list = self.get_upload_url(path, upload_id, file_id, chunk_size, part_number)
                 if not part_info_list:
                     # 重新上传
                     if str(get_real_path(path)) in path_list:
@@ -383,7 +458,8 @@ class AliyunPan(object):
                         del path_list[str(get_real_path(path))]
                     GLOBAL_VAR.tasks[content_hash].path = path_list[0] if len(path_list) == 1 else path_list
                     return self.upload_file(parent_file_id=parent_file_id, path=path, upload_timeout=upload_timeout,
-                                            retry_num=retry_num, force=force, chunk_size=self._chunk_size, c=c)
+                                            retry_num=retry_num, force=force, chunk_size=chunk_size, c=c,
+                                            ignore=ignore, workers=workers)
             except FileExistsError:
                 # 漏网之鱼
                 self._print.upload_info(path, status=True, existed=True)
@@ -402,8 +478,8 @@ class AliyunPan(object):
                 logger.error(message)
                 raise AliyunpanException(message)
             task_info = {'path': str(get_real_path(path)), 'upload_id': None,
-                         'file_id': None, 'chunk_size': self._chunk_size,
-                         'part_number': None}
+                         'file_id': None, 'chunk_size': chunk_size,
+                         'part_number': None, 'parallel_upload': workers > 1}
             rapid_upload = r.json()['rapid_upload']
             # 快速上传成功
             if rapid_upload:
@@ -428,84 +504,98 @@ class AliyunPan(object):
                 task_info['file_id'] = file_id
                 task_info['part_number'] = 1
                 GLOBAL_VAR.tasks[content_hash] = task_info
-        upload_bar = UploadBar(size=file_size)
+        return self._upload_content(f, path, content_hash, upload_id, file_id, part_info_list, chunk_size,
+                                    upload_timeout, retry_num, workers, ignore, cancel_event=cancel_event)
+
+    def _stream_upload(self, f, parent_file_id: str, path: Path, stat, part_info_list: list, chunk_size: int,
+                       upload_timeout: float, retry_num: int, force: bool, c: bool, ignore: bool, workers: int,
+                       probe: bool = True, cancel_event: Event = None):
+        """
+        不预先计算sha1，边读取分块边上传并计算sha1，只读取一次文件
+        probe为True时先用文件前1KB的sha1预检，服务器判断可能秒传时返回None
+        """
+        pre_hash = hashlib.sha1(read_range(f, 0, self._pre_hash_size)).hexdigest()
+        # 未计算完整sha1，以预哈希、大小和修改时间作为任务标识
+        task_key = f'{pre_hash}:{stat.st_size}:{stat.st_mtime_ns}'
+        task = GLOBAL_VAR.tasks.get(task_key)
+        upload_id = file_id = None
+        # 断点续传且已存在该文件的任务
+        if c and task and task.upload_id and get_real_path(task.path) == get_real_path(path):
+            try:
+                part_info_list = self.get_upload_url(path, task.upload_id, task.file_id, task.chunk_size,
+                                                     task.part_number)
+            except FileExistsError:
+                self._print.upload_info(path, status=True, existed=True)
+                self._print.print_line()
+                return task.file_id
+            if part_info_list:
+                upload_id, file_id, chunk_size = task.upload_id, task.file_id, task.chunk_size
+                if not task.parallel_upload:
+                    workers = 1
+        if not upload_id:
+            json = {"size": stat.st_size, "part_info_list": part_info_list, 'parallel_upload': workers > 1}
+            if probe:
+                json['pre_hash'] = pre_hash
+            r = self.create_file(file_name=path.name, parent_file_id=parent_file_id, file_type=True, json=json,
+                                 force=force)
+            if r.json().get('code') == AliyunpanCode.pre_hash_matched:
+                logger.info(f'The pre_hash of file {path} matched.')
+                return None
+            if 'upload_id' not in r.json():
+                message = r.json()['message']
+                logger.error(message)
+                raise AliyunpanException(message)
+            upload_id = r.json()['upload_id']
+            file_id = r.json()['file_id']
+            part_info_list = r.json()['part_info_list']
+            GLOBAL_VAR.tasks[task_key] = {'path': str(get_real_path(path)), 'upload_id': upload_id,
+                                          'file_id': file_id, 'chunk_size': chunk_size, 'part_number': 1,
+                                          'parallel_upload': workers > 1}
+        sha1 = hashlib.sha1()
+        file_info = self._upload_content(f, path, task_key, upload_id, file_id, part_info_list, chunk_size,
+                                         upload_timeout, retry_num, workers, ignore, sha1, cancel_event)
+        if file_info:
+            HashCache().set(path, sha1.hexdigest(), stat)
+        return file_info or False
+
+    def _upload_content(self, f, path: Path, task_key: str, upload_id: str, file_id: str, part_info_list: list,
+                        chunk_size: int, upload_timeout: float, retry_num: int, workers: int, ignore: bool,
+                        sha1=None, cancel_event: Event = None):
+        """
+        上传分块并保存文件
+        :param f: 已打开的文件
+        :param path:
+        :param task_key: 断点续传任务标识
+        :param upload_id:
+        :param file_id:
+        :param part_info_list:
+        :param chunk_size:
+        :param upload_timeout:
+        :param retry_num:
+        :param workers:
+        :param ignore:
+        :param sha1: 边上传边计算sha1，保存后与服务器计算的sha1比较
+        :param cancel_event: 取消上传
+        :return:
+        """
+        upload_bar = UploadBar(size=path.stat().st_size)
         upload_bar.upload_info(path)
         upload_bar.print_line()
         upload_bar.update(refresh_line=False)
         logger.debug(f'upload_id: {upload_id}, file_id: {file_id}, part_info_list: {part_info_list}')
-        part_info_list = Iter(part_info_list)
-        for i in part_info_list:
-            part_number, upload_url = i['part_number'], i['upload_url']
-            if not upload_url:
-                continue
-            GLOBAL_VAR.tasks[content_hash].part_number = part_number
-            # 分块读取
-            with path.open('rb') as f:
-                f.seek((part_number - 1) * self._chunk_size)
-                chunk = f.read(self._chunk_size)
-            if not chunk:
-                break
-            size = len(chunk)
-            retry_count = 0
-            while True:
-                upload_bar.update(refresh_line=True)
-                logger.debug(
-                    f'(upload_id={upload_id}, file_id={file_id}, size={size}): Upload part of {part_number} to {upload_url}.')
-                try:
-                    # 开始上传
-                    r = self._req.put(upload_url, data=chunk, timeout=upload_timeout, access_token=False)
-                    if r.status_code == AliyunpanCode.request_expired:
-                        raise UploadUrlExpired
-                    elif r.status_code == AliyunpanCode.part_already_exist:
-                        pass
-                    elif r.status_code == AliyunpanCode.part_not_sequential:
-                        raise PartNotSequential
-                    elif r.status_code != 200:
-                        logger.error(r.status_code)
-                        raise BadResponseCode
-                    break
-                except (requests.exceptions.SSLError, requests.exceptions.ConnectionError,
-                        requests.exceptions.ReadTimeout):
-                    logger.warn('Upload timeout.')
-                    if retry_count is retry_num:
-                        self._print.error_info(f'上传超时{retry_num}次，即将重新上传', refresh_line=True)
-                        time.sleep(1)
-                        return self.upload_file(parent_file_id=parent_file_id, path=path, upload_timeout=upload_timeout,
-                                                retry_num=retry_num, force=force, chunk_size=self._chunk_size, c=c)
-                    self._print.error_info('上传超时', refresh_line=True)
-                    retry_count += 1
-                    time.sleep(1)
-                except KeyboardInterrupt:
-                    raise
-                except UploadUrlExpired:
-                    info = f'Part {part_number} upload request has expired.'
-                    logger.warning(info)
-                    self._print.error_info(info, refresh_line=True)
-                    time.sleep(1)
-                    part_info_list_ = self.get_upload_url(path=path, upload_id=upload_id, file_id=file_id,
-                                                          chunk_size=self._chunk_size)
-                    if part_info_list_:
-                        part_info_list.iter = part_info_list_
-                        part_info = [i for i in part_info_list if i['part_number'] == part_number][0]
-                        upload_url = part_info['upload_url']
-                        logger.info(f'The upload_url of Part {part_number} has been refreshed.')
-                        logger.debug(upload_url)
-                    else:
-                        logger.error(f'The upload_url of Part {part_number} failed to refresh.')
-                        raise UploadUrlFailedRefresh
-                except (BadResponseCode, PartNotSequential):
-                    raise
-                except:
-                    logger.error(sys.exc_info())
-                    exc_type, exc_value, exc_traceback = sys.exc_info()
-                    self._print.error_info(exc_type.__name__, refresh_line=True)
-                    time.sleep(1)
-                self._print.wait_info(refresh_line=True)
-            k = part_number / len(part_info_list)
-            upload_bar.update(ratio=k, refresh_line=True)
+        limiter = RateLimiter(self._file_upload_rate, self._upload_limiter)
+        self._upload_parts(f, path, part_info_list, upload_id, file_id, chunk_size, GLOBAL_VAR.tasks[task_key],
+                           upload_timeout, retry_num, workers, upload_bar, sha1, limiter, cancel_event)
         file_info = None
         try:
             file_info = self.complete(file_id, upload_id)
+            if sha1 is not None and file_info and file_info.get('content_hash') and \
+                    file_info['content_hash'].lower() != sha1.hexdigest():
+                # 上传过程中文件被修改
+                logger.error(f'The SHA1 of file {path} does not match {file_info.get("content_hash")}.')
+                self.delete_file(file_id)
+                file_info = None
+                raise InvalidContentHash
         except InvalidContentHash:
             if not ignore:
                 upload_bar.upload_info(path, status=False, refresh_line=True)
@@ -515,8 +605,8 @@ class AliyunPan(object):
             upload_bar.upload_info(path, status=True, t=upload_bar.time, average_speed=upload_bar.average_speed,
                                    refresh_line=True)
             self._print.print_line()
-            GLOBAL_VAR.tasks[content_hash].upload_time = time.time()
-            GLOBAL_VAR.file_set.add((content_hash, str(get_real_path(path))))
+            GLOBAL_VAR.tasks[task_key].upload_time = time.time()
+            GLOBAL_VAR.file_set.add((task_key, str(get_real_path(path))))
             return file_info
         else:
             if not ignore:
@@ -524,6 +614,168 @@ class AliyunPan(object):
                 self._print.print_line()
             return False
 
+    def _upload_parts(self, f, path: Path, part_info_list: list, upload_id: str, file_id: str, chunk_size: int,
+                      task: DATA, upload_timeout: float, retry_num: int, workers: int, upload_bar: UploadBar,
+                      sha1=None, limiter: RateLimiter = None, cancel_event: Event = None):
+        """
+        并发上传分块，全部成功后返回
+        :param f: 已打开的文件
+        :param path:
+        :param part_info_list: 分块列表，upload_url为空的分块已上传
+        :param upload_id:
+        :param file_id:
+        :param chunk_size:
+        :param task: 断点续传任务
+        :param upload_timeout:
+        :param retry_num:
+        :param workers: 并发数
+        :param upload_bar:
+        :param sha1: 边读边计算sha1，按顺序读取分块后再提交上传
+        :param limiter: 该文件的限速
+        :param cancel_event: 多个文件共用的取消信号，与stop_event不同，不因该文件失败而设置
+        :return:
+        """
+        file_size = path.stat().st_size
+        done_set = {i['part_number'] for i in part_info_list if not i['upload_url']}
+        # 文件大小为分块大小整数倍时最后一个分块为空
+        part_info_list = [i for i in part_info_list if (i['part_number'] - 1) * chunk_size < file_size]
+        uploaded_size = min(len(done_set) * chunk_size, file_size)
+        lock = Lock()
+        stop_event = Event()
+        # 限制已提交未完成的分块数，边上传边计算sha1时读取不会领先上传太多
+        semaphore = Semaphore(workers * 2)
+        executor = ThreadPoolExecutor(max_workers=workers)
+
+        def part_done(part_number, future):
+            nonlocal uploaded_size
+            semaphore.release()
+            if future.cancelled() or future.exception():
+                stop_event.set()
+                return
+            size = future.result()
+            if size is None:
+                return
+            with lock:
+                uploaded_size += size
+                done_set.add(part_number)
+                # 分块可能乱序完成，只记录连续完成的位置，断点续传时从第一个未完成的分块开始
+                part_number = task.part_number or 1
+                while part_number in done_set:
+                    part_number += 1
+                task.part_number = part_number
+                upload_bar.update(ratio=uploaded_size / file_size if file_size else 1, refresh_line=True)
+
+        future_list = []
+        try:
+            for part_info in part_info_list:
+                if sha1 is not None:
+                    # 已上传的分块也需要读取以计算sha1，分块上传时从系统缓存读取
+                    offset = (part_info['part_number'] - 1) * chunk_size
+                    end = min(offset + chunk_size, file_size)
+                    for i in range(offset, end, 4194304):
+                        sha1.update(read_range(f, i, min(4194304, end - i)))
+                if not part_info['upload_url']:
+                    continue
+                semaphore.acquire()
+                if stop_event.is_set() or (cancel_event and cancel_event.is_set()):
+                    break
+                future = executor.submit(self._upload_part, f, path, part_info, upload_id, file_id, chunk_size,
+                                         upload_timeout, retry_num, stop_event, limiter, cancel_event)
+                future.add_done_callback(partial(part_done, part_info['part_number']))
+                future_list.append(future)
+            for future in future_list:
+                future.result()
+            if cancel_event and cancel_event.is_set():
+                raise UploadCancelled
+        except BaseException:
+            # 任一分块失败则取消剩余分块
+            stop_event.set()
+            for future in future_list:
+                future.cancel()
+            raise
+        finally:
+            executor.shutdown(wait=False)
+
+    def _upload_part(self, f, path: Path, part_info: dict, upload_id: str, file_id: str, chunk_size: int,
+                     upload_timeout: float, retry_num: int, stop_event: Event = None,
+                     limiter: RateLimiter = None, cancel_event: Event = None) -> int:
+        """
+        上传单个分块
+        :param f: 已打开的文件
+        :param path:
+        :param part_info:
+        :param upload_id:
+        :param file_id:
+        :param chunk_size:
+        :param upload_timeout:
+        :param retry_num:
+        :param stop_event: 停止上传
+        :param limiter: 限速
+        :param cancel_event: 取消上传，设置后中断正在发送的分块
+        :return: 分块大小，停止上传时返回None
+        """
+        part_number, upload_url = part_info['part_number'], part_info['upload_url']
+        offset = (part_number - 1) * chunk_size
+        size = max(min(chunk_size, path.stat().st_size - offset), 0)
+        retry_count = 0
+        while not (stop_event and stop_event.is_set()) and not (cancel_event and cancel_event.is_set()):
+            logger.debug(
+                f'(upload_id={upload_id}, file_id={file_id}, size={size}): Upload part of {part_number} to {upload_url}.')
+            try:
+                # 开始上传
+                start_time = time.time()
+                # 每次上传从头读取分块，不在内存中保存整个分块
+                data = PartReader(f, offset, size, cancel_event) if size else b''
+                if size and limiter and limiter.limited:
+                    data = ThrottledReader(data, size, limiter)
+                r = self._req.put(upload_url, data=data, timeout=upload_timeout, access_token=False)
+                if r.status_code == AliyunpanCode.request_expired:
+                    raise UploadUrlExpired
+                elif r.status_code == AliyunpanCode.part_already_exist:
+                    pass
+                elif r.status_code == AliyunpanCode.part_not_sequential:
+                    raise PartNotSequential
+                elif r.status_code != 200:
+                    logger.error(r.status_code)
+                    raise BadResponseCode
+                self._chunk_sizer.record(size, time.time() - start_time)
+                return size
+            except (requests.exceptions.SSLError, requests.exceptions.ConnectionError,
+                    requests.exceptions.ReadTimeout):
+                logger.warning('Upload timeout.')
+                if retry_count >= retry_num:
+                    raise UploadTimeout(f'Part {part_number} upload timed out {retry_num} times.')
+                self._print.error_info('上传超时', refresh_line=True)
+                retry_count += 1
+                time.sleep(1)
+            except UploadUrlExpired:
+                info = f'Part {part_number} upload request has expired.'
+                logger.warning(info)
+                self._print.error_info(info, refresh_line=True)
+                time.sleep(1)
+                # 只刷新当前分块的上传链接
+                part_info_list = self.get_upload_url(path=path, upload_id=upload_id, file_id=file_id,
+                                                     chunk_size=chunk_size, part_number_list=[part_number])
+                part_info_list = [i for i in part_info_list if i['part_number'] == part_number and i['upload_url']]
+                if part_info_list:
+                    upload_url = part_info_list[0]['upload_url']
+                    logger.info(f'The upload_url of Part {part_number} has been refreshed.')
+                    logger.debug(upload_url)
+                else:
+                    logger.error(f'The upload_url of Part {part_number} failed to refresh.')
+                    raise UploadUrlFailedRefresh
+            except (BadResponseCode, PartNotSequential):
+                raise
+            except UploadCancelled:
+                return None
+            except:
+                logger.error(sys.exc_info())
+                exc_type, exc_value, exc_traceback = sys.exc_info()
+                self._print.error_info(exc_type.__name__, refresh_line=True)
+                time.sleep(1)
+            self._print.wait_info(refresh_line=True)
+        return None
+
     def complete(self, file_id, upload_id):
         """
         上传成功保存文件
@@ -543,7 +795,8 @@ class AliyunPan(object):
             return r.json()
         return False
 
-    def get_upload_url(self, path: str, upload_id: str, file_id: str, chunk_size: int, part_number: int = 1) -> list:
+    def get_upload_url(self, path: str, upload_id: str, file_id: str, chunk_size: int, part_number: int = 1,
+                       part_number_list: list = None) -> list:
         """
         获取上传地址
         :param path:
@@ -551,15 +804,20 @@ class AliyunPan(object):
         :param file_id:
         :param chunk_size:
         :param part_number:
+        :param part_number_list: 只获取指定分块的上传地址
         :return:
         """
         url = 'https://api.aliyundrive.com/v2/file/get_upload_url'
         path = Path(path)
         file_size = path.stat().st_size
         part_info_list = []
-        count = int(file_size / chunk_size) + 1
-        for i in range(count):
-            part_info_list.append({"part_number": i + 1})
+        if part_number_list:
+            part_info_list = [{"part_number": i} for i in part_number_list]
+            part_number = 1
+        else:
+            count = int(file_size / chunk_size) + 1
+            for i in range(count):
+                part_info_list.append({"part_number": i + 1})
         json = {
             "drive_id": self.drive_id,
             "file_id": file_id,
@@ -645,30 +903,132 @@ class AliyunPan(object):
             else:
                 drive_id = self.get_drive_id()
 
-    def get_download_url(self, file_id, expire_sec=14400, category=None) -> str:
+    def get_download_url(self, file_id, expire_sec=None, category=None, refresh=False) -> str:
         """
         获取分享链接
         :param file_id:
-        :param expire_sec: 文件过期时间（秒）
+        :param expire_sec: 文件过期时间（秒），指定时只使用剩余有效时间足够的缓存，默认14400
         :param category:
+        :param refresh: 不使用缓存的链接，如链接已失效
         :return:
         """
+        drive_id = self.drive_id
+        key = (drive_id, file_id, category or '')
+        if not refresh:
+            url = self._url_cache.get(key, expire_sec or 0)
+            if url:
+                return url
+        expire_sec = expire_sec or 14400
+        start_time = time.time()
         url = 'https://api.aliyundrive.com/v2/file/get_download_url'
-        illegal_url = 'https://pds-system-file.oss-cn-beijing.aliyuncs.com/illegal.mp4'
-        json = {'drive_id': self.drive_id, 'file_id': file_id, 'expire_sec': expire_sec}
+        json = {'drive_id': drive_id, 'file_id': file_id, 'expire_sec': expire_sec}
         logger.info(f'Get file {file_id} download link, expiration time {expire_sec} seconds.')
         r = self._req.post(url, json=json)
         url = r.json()['url'] if 'url' in r.json() else ''
-        if not url or url == illegal_url:
+        if url and url != self._illegal_url:
+            self._url_cache.set(key, url, start_time + expire_sec)
+        else:
+            # 违规文件只能获取转码后的播放链接，不是原文件，不缓存
             url_dict = self.get_play_info(file_id, expire_sec, category) if category else \
                 self.get_play_info(file_id, expire_sec, 'video') or self.get_play_info(file_id, expire_sec, 'audio')
             if url_dict:
                 url = list(url_dict.values())[-1]
+                self._fallback_url_set.add(url)
             elif 'internal_url' in r.json() and r.json()['internal_url']:
                 url = r.json()['internal_url']
         logger.debug(f'file_id:{file_id},expire_sec:{expire_sec},url:{url}')
         return url
 
+    def is_original_url(self, url: str) -> bool:
+        """
+        下载链接是否为原文件，转码后的播放链接无法校验sha1
+        :param url:
+        :return:
+        """
+        return url not in self._fallback_url_set
+
+    def open(self, file_id: str, size: int = None, name: str = '', block_size: int = 1048576, cache_size: int = 16,
+             category=None) -> io.BufferedReader:
+        """
+        以只读方式打开云盘文件，只请求读取的部分
+        :param file_id:
+        :param size: 文件大小，不指定时从下载链接获取
+        :param name: 文件名
+        :param block_size: 每次请求的最小大小
+        :param cache_size: 缓存的块数
+        :param category:
+        :return: 可随机读取的文件对象
+        """
+        raw = RemoteFile(self.get_download_url(file_id, category=category), size=size,
+                         url_getter=partial(self.get_download_url, file_id, category=category, refresh=True),
+                         name=name or file_id, block_size=block_size, cache_size=cache_size)
+        return io.BufferedReader(raw, buffer_size=block_size)
+
+    def get_download_urls(self, file_id_list: list, expire_sec=None, category=None, batch_size: int = 100,
+                          refresh=False) -> dict:
+        """
+        批量获取下载链接，未缓存的链接通过/v2/batch获取，批量获取失败的逐个获取
+        :param file_id_list:
+        :param expire_sec: 文件过期时间（秒），指定时只使用剩余有效时间足够的缓存，默认14400
+        :param category:
+        :param batch_size: 每次批量请求的文件数
+        :param refresh: 不使用缓存的链接
+        :return: {file_id: url}
+        """
+        drive_id = self.drive_id
+        url_dict = {}
+        miss_list = []
+        for file_id in dict.fromkeys(file_id_list):
+            url = None if refresh else self._url_cache.get((drive_id, file_id, category or ''), expire_sec or 0)
+            if url:
+                url_dict[file_id] = url
+            else:
+                miss_list.append(file_id)
+        if not miss_list:
+            return url_dict
+        expire_sec = expire_sec or 14400
+        logger.info(f'Get download links of {len(miss_list)} files, expiration time {expire_sec} seconds.')
+        start_time = time.time()
+        request_list = [{'body': {'drive_id': drive_id, 'file_id': file_id, 'expire_sec': expire_sec},
+                         'headers': {'Content-Type': 'application/json'}, 'id': file_id, 'method': 'POST',
+                         'url': '/file/get_download_url'} for file_id in miss_list]
+        response_dict = self.batch_request(request_list, batch_size)
+        failed_list = []
+        for file_id in miss_list:
+            response = response_dict.get(file_id) or {}
+            url = (response.get('body') or {}).get('url')
+            if response.get('status') == 200 and url and url != self._illegal_url:
+                self._url_cache.set((drive_id, file_id, category or ''), url, start_time + expire_sec)
+                url_dict[file_id] = url
+            else:
+                failed_list.append(file_id)
+        if failed_list:
+            logger.warning(f'Failed to get download links of {len(failed_list)} files in batch.')
+        for file_id in failed_list:
+            url_dict[file_id] = self.get_download_url(file_id, expire_sec, category, refresh=True)
+        return url_dict
+
+    def batch_request(self, request_list: list, batch_size: int = 100) -> dict:
+        """
+        分批发送/v2/batch请求
+        :param request_list: 子请求列表，id不能重复
+        :param batch_size: 每次请求的子请求数
+        :return: {id: 子请求的响应}，请求失败的批次不包含在内
+        """
+        url = 'https://api.aliyundrive.com/v2/batch'
+        response_dict = {}
+        for i in range(0, len(request_list), batch_size):
+            json = {'requests': request_list[i:i + batch_size], 'resource': 'file'}
+            try:
+                r = self._req.post(url, json=json)
+                response_list = r.json().get('responses') or []
+            except (requests.exceptions.RequestException, ValueError):
+                logger.error(sys.exc_info())
+                continue
+            for response in response_list:
+                response_dict[response.get('id')] = response
+        return response_dict
+
     def save_share_link(self, name: str, content_hash: str, proof_code: str, content_hash_name: str, size: str,
                         parent_file_id: str = 'root', force: bool = False) -> bool:
         """
@@ -704,6 +1064,21 @@ class AliyunPan(object):
         :param limit
         :param category_list
         """
+        return list(self.iter_search(query, raw=raw, limit=limit_num, category_list=category_list,
+                                     next_marker=next_marker, max_page=1 if limit else None))
+
+    def iter_search(self, query: str, raw=False, limit: int = 100, category_list=None, next_marker: str = None,
+                    max_page: int = None):
+        """
+        逐页搜索文件，每页返回后立即产出
+        :param query:
+        :param raw: query为原始查询语句
+        :param limit: 每页的文件数
+        :param category_list:
+        :param next_marker: 从指定的marker开始
+        :param max_page: 最多获取的页数
+        :return: 文件信息的迭代器
+        """
         url = 'https://api.aliyundrive.com/v2/file/search'
         if not raw:
             query = f'name match \"{query}\"'
@@ -712,23 +1087,25 @@ class AliyunPan(object):
                 if query:
                     query += ' and '
                 query += f'category = \"{i}\"'
-        json = {
-            'drive_id': self.drive_id,
-            'query': query,
-            'order_by': 'updated_at DESC',
-            'limit': limit_num
-        }
-        if next_marker:
-            json['marker'] = next_marker
-        r = self._req.post(url, json=json)
-        if 'items' not in r.json():
-            return []
-        file_list = r.json()['items']
-        if 'next_marker' in r.json() and r.json()['next_marker'] and \
-                next_marker != r.json()['next_marker'] and not limit:
-            file_list.extend(
-                self.search(query, raw=True, next_marker=r.json()['next_marker'], limit_num=limit_num))
-        return file_list
+        page = 0
+        while True:
+            json = {
+                'drive_id': self.drive_id,
+                'query': query,
+                'order_by': 'updated_at DESC',
+                'limit': limit
+            }
+            if next_marker:
+                json['marker'] = next_marker
+            data = self._req.post(url, json=json).json()
+            if 'items' not in data:
+                return
+            yield from data['items']
+            page += 1
+            marker = data.get('next_marker')
+            if not marker or marker == next_marker or max_page and page >= max_page:
+                return
+            next_marker = marker
 
     def get_play_info(self, file_id, expire_sec=14400, category=None):
         url = 'https://api.aliyundrive.com/v2/databox/get_{}_play_info'
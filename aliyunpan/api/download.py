@@ -0,0 +1,566 @@
+import errno
+import hashlib
+import heapq
+import io
+import itertools
+import json
+import os
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, Future
+from functools import partial
+from pathlib import Path
+from threading import Lock, Event, Thread
+
+import requests
+
+from aliyunpan.api.req import Req
+from aliyunpan.api.utils import logger, read_range, write_range, allocate, parse_size, get_sha1, RateLimiter
+from aliyunpan.common import DownloadBar
+from aliyunpan.exceptions import AliyunpanCode, DownloadUrlExpired, DownloadFailed, \
+    DownloadHashMismatch
+
+__all__ = ['Downloader', 'DownloadScheduler', 'RemoteFile']
+
+
+class Downloader:
+    """
+    分段下载，多个连接同时下载文件的不同范围，每段的进度保存在同目录的.aliyunpan文件
+    下载前按文件大小预先分配磁盘空间，各段直接写入对应位置
+    指定sha1时边下载边按顺序计算，乱序下载的部分在轮到时从文件读取，续传时已下载的部分只读取一次
+    """
+    _state_suffix = '.aliyunpan'
+
+    def __init__(self, path, url: str, size: int = None, url_getter=None, workers: int = 1,
+                 chunk_size: int = 1048576, retry_num: int = 3, min_segment_size: int = 4194304,
+                 content_hash: str = None, sparse: bool = False, limiter: RateLimiter = None):
+        """
+        :param path: 保存路径
+        :param url: 下载链接
+        :param size: 文件大小，不指定时从下载链接获取
+        :param url_getter: 下载链接过期时获取新链接
+        :param workers: 同时下载的分段数
+        :param chunk_size: 每次写入的大小
+        :param retry_num: 每段失败重试次数
+        :param min_segment_size: 最小分段大小
+        :param content_hash: 文件sha1，指定时下载完成后校验，不一致时重新下载
+        :param sparse: 不预先分配磁盘空间
+        :param limiter: 限速
+        """
+        self._path = Path(path)
+        self._url = url
+        self._size = size
+        self._url_getter = url_getter
+        self._workers = max(workers or 1, 1)
+        self._chunk_size = chunk_size
+        self._retry_num = retry_num
+        self._min_segment_size = min_segment_size
+        self._req = Req()
+        self._lock = Lock()
+        self._stop_event = Event()
+        # [[起始位置, 结束位置, 已下载到的位置]]
+        self._segments = []
+        self._save_time = 0
+        self._download_bar = None
+        self._sparse = sparse
+        self._limiter = limiter if limiter and limiter.limited else None
+        self._content_hash = content_hash.upper() if content_hash else None
+        self._sha1 = None
+        # 已计算sha1的位置
+        self._hash_pos = 0
+        self._hash_lock = Lock()
+        # 是否有线程正在从文件读取计算sha1
+        self._hashing = False
+
+    path = property(lambda self: self._path)
+    size = property(lambda self: self._size)
+    state_file = property(lambda self: self._path.with_name(self._path.name + self._state_suffix))
+    downloaded_size = property(lambda self: sum(i[2] - i[0] for i in self._segments))
+    download_bar = property(lambda self: self._download_bar)
+
+    def _get_size(self) -> int:
+        try:
+            r = self._request(0, 0)
+        except requests.exceptions.RequestException as e:
+            # 空文件的Range请求返回416
+            if e.response is not None and e.response.status_code == 416:
+                return 0
+            raise
+        content_range = r.headers.get('Content-Range', '')
+        r.close()
+        if '/' in content_range:
+            return int(content_range.split('/')[-1])
+        return int(r.headers['Content-Length'])
+
+    def _request(self, start: int, end: int) -> requests.Response:
+        """
+        请求指定范围，下载链接过期时刷新
+        """
+        url = self._url
+        r = self._req.get(url, headers={'Range': f'bytes={start}-{end}'}, stream=True)
+        if r.status_code == AliyunpanCode.request_expired:
+            r.close()
+            self._refresh_url(url)
+            raise DownloadUrlExpired
+        if r.status_code not in (200, 206):
+            r.close()
+            logger.error(f'Download {self._path} got status code {r.status_code}.')
+            raise requests.exceptions.RequestException(r.status_code, response=r)
+        if r.status_code == 200 and start:
+            r.close()
+            raise requests.exceptions.RequestException('Range is not supported.')
+        return r
+
+    def _refresh_url(self, url: str):
+        with self._lock:
+            if not self._url_getter:
+                raise DownloadFailed('Download url has expired.')
+            # 其他分段已刷新
+            if self._url != url:
+                return
+            logger.info(f'Download url of {self._path} has expired.')
+            self._url = self._url_getter()
+
+    def _split(self):
+        segment_size = max(-(-self._size // self._workers), self._min_segment_size)
+        self._segments = [[start, min(start + segment_size, self._size), start]
+                          for start in range(0, self._size, segment_size)]
+
+    def _load_state(self) -> bool:
+        """
+        读取分段进度
+        :return: 是否存在与文件大小一致的进度
+        """
+        try:
+            state = json.loads(self.state_file.read_text(encoding='utf-8'))
+        except (OSError, ValueError):
+            return False
+        if state.get('size') != self._size or not self._path.exists():
+            return False
+        self._segments = state['segments']
+        return True
+
+    def _save_state(self, force=True):
+        with self._lock:
+            if not force and time.time() - self._save_time < 1:
+                return
+            self._save_time = time.time()
+            state = json.dumps({'size': self._size, 'segments': self._segments})
+            temp_file = self.state_file.with_name(self.state_file.name + '.tmp')
+            temp_file.write_text(state, encoding='utf-8')
+            os.replace(temp_file, self.state_file)
+
+    def _prepare(self):
+        if self._load_state():
+            return
+        self._split()
+        if self._path.exists():
+            temp_size = self._path.stat().st_size
+            # 没有分段进度时，比完整文件小的部分视为从头顺序下载的内容
+            # 预先分配的文件与完整文件大小相同，无法判断已下载的部分，从头下载
+            if temp_size < self._size:
+                for segment in self._segments:
+                    segment[2] = min(max(segment[0], temp_size), segment[1])
+        exists = self._path.exists()
+        try:
+            with self._path.open('r+b' if exists else 'wb') as f:
+                allocate(f, self._size, self._sparse)
+        except OSError as e:
+            if e.errno != errno.ENOSPC:
+                raise
+            if not exists:
+                self._path.unlink()
+            raise DownloadFailed(f'No space left for {self._path} ({self._size} bytes).')
+        self._save_state()
+
+    def _download_segment(self, f, segment: list):
+        retry_count = 0
+        while segment[2] < segment[1] and not self._stop_event.is_set():
+            try:
+                r = self._request(segment[2], segment[1] - 1)
+                with r:
+                    for chunk in r.iter_content(chunk_size=self._chunk_size):
+                        if self._stop_event.is_set():
+                            return
+                        if not chunk:
+                            continue
+                        chunk = chunk[:segment[1] - segment[2]]
+                        if self._limiter:
+                            self._limiter.consume(len(chunk))
+                        offset = segment[2]
+                        write_range(f, offset, chunk)
+                        with self._lock:
+                            segment[2] += len(chunk)
+                        self._hash(f, offset, chunk)
+                        self._update()
+                        if segment[2] >= segment[1]:
+                            break
+                retry_count = 0
+            except (requests.exceptions.RequestException, DownloadUrlExpired) as e:
+                logger.warning(f'Download segment {segment} of {self._path} failed.')
+                if retry_count >= self._retry_num:
+                    raise
+                retry_count += 1
+                if not isinstance(e, DownloadUrlExpired):
+                    time.sleep(1)
+
+    def _hash(self, f, offset: int = None, chunk: bytes = b''):
+        """
+        按顺序计算sha1，刚写入的块位于已计算的位置时直接计算，否则等轮到时从文件读取
+        同时只有一个线程从文件读取，读取时不持有锁，其他分段继续下载
+        :param f:
+        :param offset: 刚写入的位置
+        :param chunk: 刚写入的内容
+        :return:
+        """
+        if not self._sha1:
+            return
+        with self._hash_lock:
+            if self._hashing:
+                return
+            if offset == self._hash_pos:
+                self._sha1.update(chunk)
+                self._hash_pos += len(chunk)
+            self._hashing = True
+        while True:
+            with self._hash_lock:
+                start, end = self._hash_pos, self._hash_end()
+                if start >= end:
+                    self._hashing = False
+                    return
+            try:
+                data = read_range(f, start, min(end - start, 4194304))
+            except BaseException:
+                with self._hash_lock:
+                    self._hashing = False
+                raise
+            with self._hash_lock:
+                self._sha1.update(data)
+                self._hash_pos += len(data)
+
+    def _hash_end(self) -> int:
+        """
+        从已计算sha1的位置起连续下载完成的结束位置
+        """
+        end = self._hash_pos
+        for segment in self._segments:
+            if segment[1] <= end:
+                continue
+            end = max(end, segment[2])
+            if segment[2] < segment[1]:
+                break
+        return end
+
+    def _update(self):
+        if self._download_bar:
+            self._download_bar.update(ratio=self.downloaded_size / self._size if self._size else 1,
+                                      refresh_line=True)
+        self._save_state(force=False)
+
+    def download(self) -> bool:
+        """
+        下载文件
+        :return: 文件已存在且sha1一致时返回False
+        """
+        if not self._url and self._url_getter:
+            self._url = self._url_getter()
+        if self._size is None:
+            self._size = self._get_size()
+        if not self._load_state() and self._path.exists() and self._path.stat().st_size == self._size \
+                and self._size and (not self._content_hash or get_sha1(self._path).upper() == self._content_hash):
+            # 没有分段进度且大小一致时视为已存在，有sha1时一致才跳过，避免跳过只是预先分配了空间的文件
+            return False
+        self._path.parent.mkdir(parents=True, exist_ok=True)
+        if not self._size:
+            # 空文件不需要下载
+            self._path.open('wb').close()
+            return True
+        self._download_bar = DownloadBar(size=self._size)
+        self._download_bar.update(refresh_line=False)
+        retry_count = 0
+        while True:
+            self._prepare()
+            self._download()
+            if not self._content_hash or self._sha1.hexdigest().upper() == self._content_hash:
+                break
+            logger.error(f'The SHA1 of file {self._path} is {self._sha1.hexdigest().upper()}, '
+                         f'expected {self._content_hash}.')
+            # 校验失败时删除文件重新下载
+            self._path.unlink()
+            if retry_count >= self._retry_num:
+                raise DownloadHashMismatch(f'The SHA1 of file {self._path} does not match.')
+            retry_count += 1
+        self._download_bar.update(ratio=1, refresh_line=True)
+        return True
+
+    def _download(self):
+        segment_list = [i for i in self._segments if i[2] < i[1]]
+        f = self._path.open('r+b')
+        executor = ThreadPoolExecutor(max_workers=self._workers)
+        try:
+            if self._content_hash:
+                self._sha1 = hashlib.sha1()
+                self._hash_pos = 0
+                self._hashing = False
+                # 续传时从文件读取已下载的开头部分
+                self._hash(f)
+            future_list = [executor.submit(self._download_segment, f, segment) for segment in segment_list]
+            for future in future_list:
+                future.result()
+            self._hash(f)
+        except BaseException:
+            self._stop_event.set()
+            raise
+        finally:
+            executor.shutdown(wait=True)
+            f.close()
+            if self.downloaded_size == self._size:
+                try:
+                    self.state_file.unlink()
+                except FileNotFoundError:
+                    pass
+            else:
+                self._save_state()
+
+
+class DownloadScheduler:
+    """
+    下载调度，按优先级依次开始下载任务，限制同时下载的文件数和所有文件的总速度
+    """
+
+    def __init__(self, jobs: int = 1, rate=0):
+        """
+        :param jobs: 同时下载的文件数
+        :param rate: 总速度上限，如10M
+        """
+        self._jobs = max(jobs or 1, 1)
+        self._limiter = RateLimiter(parse_size(rate))
+        self._lock = Lock()
+        # [(-优先级, 序号, Future, 任务)]
+        self._queue = []
+        self._counter = itertools.count()
+        self._thread_count = 0
+        self._running = 0
+
+    limiter = property(lambda self: self._limiter)
+    rate = property(lambda self: self._limiter.rate,
+                    lambda self, value: setattr(self._limiter, 'rate', parse_size(value)))
+    pending = property(lambda self: len(self._queue))
+
+    @property
+    def jobs(self) -> int:
+        return self._jobs
+
+    @jobs.setter
+    def jobs(self, value: int):
+        with self._lock:
+            self._jobs = max(value or 1, 1)
+            self._start_threads()
+
+    def get_limiter(self, rate=0) -> RateLimiter:
+        """
+        获取单个文件的限速，多个文件平分总速度
+        :param rate: 单个文件的速度上限
+        :return:
+        """
+        return RateLimiter(parse_size(rate), self._limiter)
+
+    def submit(self, fn, *args, priority: int = 0, **kwargs) -> Future:
+        """
+        添加下载任务
+        :param fn:
+        :param args:
+        :param priority: 优先级，数值大的先开始，相同时按添加顺序
+        :param kwargs:
+        :return:
+        """
+        future = Future()
+        with self._lock:
+            heapq.heappush(self._queue, (-priority, next(self._counter), future, partial(fn, *args, **kwargs)))
+            self._start_threads()
+        return future
+
+    def _start_threads(self):
+        # 空闲的线程数少于等待的任务数时增加线程
+        while self._thread_count < self._jobs and self._thread_count - self._running < len(self._queue):
+            self._thread_count += 1
+            Thread(target=self._worker, daemon=True).start()
+
+    def _worker(self):
+        while True:
+            with self._lock:
+                # 同时下载的文件数减少时多余的线程退出
+                if not self._queue or self._thread_count > self._jobs:
+                    self._thread_count -= 1
+                    return
+                future, task = heapq.heappop(self._queue)[2:]
+                self._running += 1
+            try:
+                if future.set_running_or_notify_cancel():
+                    try:
+                        result = task()
+                    except BaseException as e:
+                        future.set_exception(e)
+                    else:
+                        future.set_result(result)
+            finally:
+                with self._lock:
+                    self._running -= 1
+
+    def cancel(self) -> int:
+        """
+        取消未开始的任务
+        :return: 取消的数量
+        """
+        with self._lock:
+            queue, self._queue = self._queue, []
+        for item in queue:
+            item[2].cancel()
+        return len(queue)
+
+
+class RemoteFile(io.RawIOBase):
+    """
+    云盘文件的只读随机访问，按块发送Range请求读取需要的部分，缓存最近读取的块
+    """
+
+    def __init__(self, url: str, size: int = None, url_getter=None, name: str = '', block_size: int = 1048576,
+                 cache_size: int = 16, retry_num: int = 3):
+        """
+        :param url: 下载链接
+        :param size: 文件大小，不指定时从下载链接获取
+        :param url_getter: 下载链接过期时获取新链接
+        :param name: 文件名
+        :param block_size: 每次请求的最小大小
+        :param cache_size: 缓存的块数
+        :param retry_num: 失败重试次数
+        """
+        super(RemoteFile, self).__init__()
+        self._url = url
+        self._size = size
+        self._url_getter = url_getter
+        self._name = name
+        self._block_size = block_size
+        self._cache_size = cache_size
+        self._retry_num = retry_num
+        self._req = Req()
+        self._lock = Lock()
+        # {块序号: 内容}
+        self._blocks = OrderedDict()
+        self._position = 0
+
+    name = property(lambda self: self._name)
+    block_size = property(lambda self: self._block_size)
+
+    @property
+    def size(self) -> int:
+        if self._size is None:
+            self._request(0, 0)
+        return self._size
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if self.closed:
+            raise ValueError('I/O operation on closed file.')
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        elif whence != io.SEEK_SET:
+            raise ValueError(f'Invalid whence ({whence}).')
+        if offset < 0:
+            raise ValueError(f'Negative seek position {offset}.')
+        self._position = offset
+        return self._position
+
+    def tell(self) -> int:
+        return self._position
+
+    def readinto(self, b) -> int:
+        if self.closed:
+            raise ValueError('I/O operation on closed file.')
+        view = memoryview(b).cast('B')
+        end = min(self._position + len(view), self.size)
+        count = 0
+        while self._position < end:
+            index, offset = divmod(self._position, self._block_size)
+            data = self._get_blocks(index, (end - 1) // self._block_size)[offset:offset + end - self._position]
+            if not data:
+                break
+            view[count:count + len(data)] = data
+            count += len(data)
+            self._position += len(data)
+        return count
+
+    def _get_blocks(self, first: int, last: int) -> bytes:
+        """
+        获取从first开始的连续块，已缓存时只返回第一块，否则一次请求到last为止未缓存的块
+        """
+        with self._lock:
+            if first in self._blocks:
+                self._blocks.move_to_end(first)
+                return self._blocks[first]
+            end = first
+            while end < last and end + 1 not in self._blocks:
+                end += 1
+        data = self._request(first * self._block_size, min((end + 1) * self._block_size, self._size) - 1)
+        with self._lock:
+            for index in range(first, end + 1):
+                start = (index - first) * self._block_size
+                self._blocks[index] = data[start:start + self._block_size]
+                self._blocks.move_to_end(index)
+            while len(self._blocks) > self._cache_size:
+                self._blocks.popitem(last=False)
+        return data
+
+    def _request(self, start: int, end: int) -> bytes:
+        """
+        请求指定范围，下载链接过期时刷新
+        """
+        for retry_count in range(self._retry_num + 1):
+            try:
+                r = self._req.get(self._url, headers={'Range': f'bytes={start}-{end}'}, stream=True)
+                with r:
+                    if r.status_code == AliyunpanCode.request_expired:
+                        if not self._url_getter:
+                            raise DownloadFailed('Download url has expired.')
+                        logger.info(f'Download url of {self._name} has expired.')
+                        self._url = self._url_getter()
+                        continue
+                    content_range = r.headers.get('Content-Range', '')
+                    if '/' in content_range:
+                        self._size = int(content_range.split('/')[-1])
+                    elif r.status_code == 200:
+                        self._size = int(r.headers['Content-Length'])
+                    # 空文件的Range请求返回416
+                    if self._size == 0:
+                        return b''
+                    if r.status_code not in (200, 206):
+                        raise requests.exceptions.RequestException(r.status_code)
+                    if r.status_code == 206:
+                        return r.content
+                    # 不支持Range时返回整个文件，丢弃start之前的内容，读到end为止
+                    data = bytearray()
+                    position = 0
+                    for chunk in r.iter_content(chunk_size=self._block_size):
+                        if position + len(chunk) > start:
+                            data += chunk[max(start - position, 0):end + 1 - position]
+                        position += len(chunk)
+                        if position > end:
+                            break
+                    return bytes(data)
+            except requests.exceptions.RequestException:
+                logger.warning(f'Read bytes {start}-{end} of {self._name} failed.')
+                if retry_count >= self._retry_num:
+                    raise
+                time.sleep(1)
+        raise DownloadFailed(f'Read bytes {start}-{end} of {self._name} failed.')
+
+    def close(self):
+        self._blocks.clear()
+        super(RemoteFile, self).close()
@@ -1,61 +1,270 @@
 import base64
 import sys
 import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from pathlib import Path, PurePosixPath
 
-from treelib import Tree
+from treelib import Node, Tree
 from treelib.exceptions import NodeIDAbsentError
 
 from aliyunpan.api.type import FileInfo, ShareInfo
-from aliyunpan.api.utils import get_sha1, get_url_byte, get_proof_code
+from aliyunpan.api.utils import get_sha1, get_url_byte, get_proof_code, logger
 from aliyunpan.common import GetFileListBar
 
 _all_ = ['PathList', 'parse_share_url', 'AliyunpanPath']
 
 
+class PathTree(Tree):
+    """
+    文件树，每个文件夹维护文件名到文件id的索引
+    """
+
+    def __init__(self, *args, **kwargs):
+        # {parent_id: {tag: file_id}}，同名文件保留先加入的
+        self._name_index = {}
+        # 有同名文件的文件夹，删除后需要重新索引
+        self._duplicate_set = set()
+        super(PathTree, self).__init__(*args, **kwargs)
+        # 从其他树复制时重新索引
+        if self.root is not None:
+            self._index_subtree(self.root)
+
+    def get_child(self, nid, tag):
+        """
+        按文件名查找子节点
+        :param nid: 文件夹id
+        :param tag: 文件名
+        :return: 文件id，不存在时返回None
+        """
+        return self._name_index.get(nid, {}).get(tag)
+
+    def _index(self, pid, node):
+        index = self._name_index.setdefault(pid, {})
+        if index.setdefault(node.tag, node.identifier) != node.identifier:
+            self._duplicate_set.add(pid)
+
+    def _unindex(self, node):
+        parent = self.parent(node.identifier)
+        if not parent:
+            return
+        index = self._name_index.get(parent.identifier, {})
+        if index.get(node.tag) != node.identifier:
+            return
+        del index[node.tag]
+        if parent.identifier in self._duplicate_set:
+            for i in self.children(parent.identifier):
+                if i.tag == node.tag and i.identifier != node.identifier:
+                    index[i.tag] = i.identifier
+                    break
+
+    def _index_subtree(self, nid):
+        for node_id in self.expand_tree(nid):
+            for child in self.children(node_id):
+                self._index(node_id, child)
+
+    def _unindex_subtree(self, nid):
+        node = self.get_node(nid)
+        if not node:
+            return
+        self._unindex(node)
+        for node_id in self.expand_tree(nid):
+            self._name_index.pop(node_id, None)
+            self._duplicate_set.discard(node_id)
+
+    def add_node(self, node, parent=None):
+        super(PathTree, self).add_node(node, parent)
+        if parent is not None:
+            self._index(parent.identifier if isinstance(parent, Node) else parent, node)
+
+    def remove_node(self, identifier):
+        self._unindex_subtree(identifier)
+        return super(PathTree, self).remove_node(identifier)
+
+    def remove_subtree(self, nid, identifier=None):
+        self._unindex_subtree(nid)
+        tree = super(PathTree, self).remove_subtree(nid, identifier)
+        if tree.root is not None:
+            tree._index_subtree(tree.root)
+        return tree
+
+    def subtree(self, nid, identifier=None):
+        tree = super(PathTree, self).subtree(nid, identifier)
+        if tree.root is not None:
+            tree._index_subtree(tree.root)
+        return tree
+
+    def paste(self, nid, new_tree, deep=False):
+        super(PathTree, self).paste(nid, new_tree, deep)
+        if new_tree.root is not None:
+            self._index(nid, self[new_tree.root])
+            self._index_subtree(new_tree.root)
+
+    def link_past_node(self, nid):
+        parent = self.parent(nid)
+        children = self.children(nid)
+        self._unindex(self[nid])
+        self._name_index.pop(nid, None)
+        self._duplicate_set.discard(nid)
+        super(PathTree, self).link_past_node(nid)
+        for child in children:
+            self._index(parent.identifier, child)
+
+    def move_node(self, source, destination):
+        self._unindex(self[source])
+        super(PathTree, self).move_node(source, destination)
+        self._index(destination, self[source])
+
+    def update_node(self, nid, **attrs):
+        node = self[nid]
+        if attrs.get('tag', node.tag) == node.tag and attrs.get('identifier', nid) == nid:
+            return super(PathTree, self).update_node(nid, **attrs)
+        parent = self.parent(nid)
+        self._unindex(node)
+        if 'identifier' in attrs and nid in self._name_index:
+            self._name_index[attrs['identifier']] = self._name_index.pop(nid)
+        super(PathTree, self).update_node(nid, **attrs)
+        if parent:
+            self._index(parent.identifier, self[attrs.get('identifier', nid)])
+
+
 class PathList:
     def __init__(self, disk):
-        self._tree = Tree()
+        self._tree = PathTree()
         self._disk = disk
         self._tree.create_node(tag='root', identifier='root', data=FileInfo(type=False))
         self.depth = 3
+        # 同时请求的文件夹数
+        self.workers = 8
+        # 本地的文件列表缓存，MetaCache
+        self.meta_cache = None
+        # 增量更新时最多获取的变更页数，超过后重新获取全部文件列表
+        self.change_pages = 10
 
-    def update_path_list(self, file_id='root', depth=None, is_fid=True, **kwargs):
+    def update_path_list(self, file_id='root', depth=None, is_fid=True, cache=False, incremental=False, **kwargs):
+        """
+        广度优先更新文件树，同时请求多个文件夹，结果返回后立即写入文件树
+        :param file_id:
+        :param depth: 向下更新的层数，float('inf')时更新整个子树
+        :param is_fid: file_id是否为文件id，否则为路径
+        :param cache: 优先使用未过期的本地缓存
+        :param incremental: 先把云盘的变更合并到本地缓存，只重新获取updated_at变化的文件夹
+        :param kwargs:
+        :return: 文件夹为空或获取失败时返回False
+        """
         if depth is None:
             depth = self.depth
-        kwargs.setdefault('max_depth', depth)
-        max_depth = kwargs['max_depth']
-        kwargs.setdefault('get_file_list_bar', GetFileListBar(max_depth))
-        kwargs.setdefault('ratio', 0)
-        get_file_list_bar = kwargs['get_file_list_bar']
-        ratio = kwargs['ratio']
+        get_file_list_bar = kwargs.get('get_file_list_bar') or GetFileListBar(depth)
         get_file_list_bar.update(refresh_line=False)
         if not is_fid:
             file_id = self.get_path_fid(file_id, update=False)
+        if incremental and self.meta_cache is not None:
+            cache = self._apply_changes()
+        # 等待请求的文件夹 [(file_id, 所在层数, updated_at)]，起始文件夹总是重新获取
+        folder_queue = deque([(file_id, 0, None)])
+        future_dict = {}
+        done_count = 0
+        result = True
+        executor = ThreadPoolExecutor(max_workers=self.workers)
+        try:
+            while folder_queue or future_dict:
+                # 限制同时请求的文件夹数，其余的等待
+                while folder_queue and len(future_dict) < self.workers * 2:
+                    folder_id, level, updated_at = folder_queue.popleft()
+                    future = executor.submit(self._get_file_list, folder_id,
+                                             cache and (updated_at is not None or not incremental), updated_at)
+                    future_dict[future] = (folder_id, level)
+                done_set = wait(future_dict, return_when=FIRST_COMPLETED).done
+                for future in done_set:
+                    folder_id, level = future_dict.pop(future)
+                    file_list = future.result()
+                    done_count += 1
+                    if not file_list:
+                        if folder_id == file_id:
+                            result = False
+                        continue
+                    self._update_children(folder_id, file_list)
+                    if level < depth:
+                        folder_queue.extend((info['file_id'], level + 1, info.get('updated_at'))
+                                            for info in file_list if info['type'] != 'file')
+                    get_file_list_bar.update(depth=level,
+                                             ratio=done_count / (done_count + len(folder_queue) + len(future_dict)),
+                                             refresh_line=True)
+        except BaseException:
+            for future in future_dict:
+                future.cancel()
+            raise
+        finally:
+            executor.shutdown(wait=False)
+        get_file_list_bar.refresh_line()
+        return result
+
+    @property
+    def _cache_drive_id(self):
+        return self._disk.share.share_id or self._disk.drive_id
+
+    def _get_file_list(self, file_id, cache=False, updated_at=None):
+        """
+        获取文件列表，获取后写入本地缓存
+        :param file_id:
+        :param cache: 优先使用未过期的本地缓存
+        :param updated_at: 文件夹当前的updated_at，与缓存时不同则重新获取
+        :return:
+        """
+        if self.meta_cache is not None and cache:
+            file_list = self.meta_cache.get_children(self._cache_drive_id, file_id, updated_at)
+            if file_list is not None:
+                return file_list
         file_list = self._disk.get_file_list(file_id)
-        if not file_list:
-            if depth == max_depth:
-                get_file_list_bar.refresh_line()
+        if self.meta_cache is not None and file_list:
+            self.meta_cache.set_children(self._cache_drive_id, file_id, file_list, updated_at)
+        return file_list
+
+    def _apply_changes(self):
+        """
+        搜索上次合并后updated_at变化的文件，合并到本地缓存
+        :return: 本地缓存是否可用，变更过多或无法获取变更时返回False
+        """
+        if self._disk.share.share_id:
+            return False
+        drive_id = self._cache_drive_id
+        changed_at = self.meta_cache.get_changed_at(drive_id)
+        # 没有合并位置时无法确定缓存是否完整，重新获取
+        if not changed_at:
             return False
-        old_file_list = self._tree.children(file_id)
-        for i in old_file_list:
-            if i.identifier not in [j['file_id'] for j in file_list]:
+        limit = 100
+        file_list = list(self._disk.iter_search(f'updated_at >= "{changed_at}"', raw=True, limit=limit,
+                                                max_page=self.change_pages))
+        logger.info(f'Get {len(file_list)} changes since {changed_at}.')
+        complete = len(file_list) < limit * self.change_pages
+        self.meta_cache.apply_changes(drive_id, file_list, complete)
+        return complete
+
+    def invalidate(self, file_id):
+        """
+        文件夹的内容已改变，使本地缓存失效
+        :param file_id: 文件夹id
+        :return:
+        """
+        if self.meta_cache is not None and file_id:
+            self.meta_cache.invalidate(self._cache_drive_id, file_id)
+
+    def _update_children(self, file_id, file_list):
+        """
+        用获取到的文件列表更新文件夹的子节点
+        """
+        id_set = {i['file_id'] for i in file_list}
+        for i in self._tree.children(file_id):
+            if i.identifier not in id_set:
                 self._tree.remove_node(i.identifier)
-        for i, info in enumerate(file_list):
-            if depth == max_depth:
-                ratio = (i + 1) / len(file_list) if file_list else None
-            get_file_list_bar.update(depth=max_depth - depth, ratio=ratio, refresh_line=True)
-            file_info = self.get_file_info(info)[0]
+        for file_info in self.get_file_info(file_list):
             if self._tree.get_node(file_info.id):
-                self._tree.update_node(file_info.id, data=file_info)
+                # 文件可能已被重命名或移动
+                if self._tree.parent(file_info.id).identifier != file_id:
+                    self._tree.move_node(file_info.id, file_id)
+                self._tree.update_node(file_info.id, tag=file_info.name, data=file_info)
             else:
                 self._tree.create_node(tag=file_info.name, identifier=file_info.id, data=file_info, parent=file_id)
-            if not file_info.type and depth:
-                self.update_path_list(file_id=file_info.id, depth=depth - 1, max_depth=max_depth,
-                                      get_file_list_bar=get_file_list_bar, ratio=ratio)
-        if depth == max_depth:
-            get_file_list_bar.refresh_line()
-        return True
 
     def check_path_diff(self, local_path, disk_path_list):
         p = Path(local_path)
@@ -159,17 +368,12 @@ class PathList:
             path_list = path_list[1:]
         for i in path_list:
             flag = False
-            node_list = self._tree.children(file_id)
-            if not node_list:
+            if not self._tree.is_branch(file_id):
                 self.auto_update_path_list(update, file_id)
-                node_list = self._tree.children(file_id)
-            for j in node_list:
-                if i == j.tag:
-                    flag = True
-                    file_id = j.identifier
-                    break
-            if not flag:
+            file_id = self._tree.get_child(file_id, i)
+            if not file_id:
                 return False
+            flag = True
         if flag:
             return file_id
         return False
@@ -190,7 +394,7 @@ class PathList:
 
     def auto_update_path_list(self, update=True, file_id=None):
         if not update and file_id:
-            return self.update_path_list(file_id, depth=0)
+            return self.update_path_list(file_id, depth=0, cache=True)
         elif update and len(self._tree) == 1:
             return self.update_path_list()
 
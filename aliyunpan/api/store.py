@@ -0,0 +1,577 @@
+import json
+import os
+import sqlite3
+import time
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from contextlib import contextmanager
+from pathlib import Path
+from threading import RLock
+
+from aliyunpan.api.utils import ROOT_DIR, logger
+from aliyunpan.common import DATA
+
+__all__ = ['SQLiteStore', 'HashCache', 'TaskJournal', 'UrlCache', 'Aria2Tasks', 'MetaCache']
+
+
+class SQLiteStore:
+    """
+    本地sqlite存储
+    """
+    _schema = ''
+
+    def __init__(self, db_file):
+        self._db_file = Path(db_file) if db_file else None
+        self._lock = RLock()
+        self._conn = None
+
+    db_file = property(lambda self: self._db_file)
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        with self._lock:
+            if not self._conn:
+                self._conn = sqlite3.connect(str(self._db_file), check_same_thread=False, isolation_level=None)
+                self._conn.execute('PRAGMA journal_mode=WAL')
+                self._conn.execute('PRAGMA synchronous=NORMAL')
+                self._conn.executescript(self._schema)
+            return self._conn
+
+    def execute(self, sql, parameters=()) -> list:
+        with self._lock:
+            return self.conn.execute(sql, parameters).fetchall()
+
+    def executemany(self, sql, seq_of_parameters):
+        with self.transaction() as conn:
+            conn.executemany(sql, seq_of_parameters)
+
+    @contextmanager
+    def transaction(self):
+        """
+        在一个事务中执行，出错时回滚
+        """
+        with self._lock:
+            conn = self.conn
+            conn.execute('BEGIN')
+            try:
+                yield conn
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+            conn.execute('COMMIT')
+
+    def close(self):
+        with self._lock:
+            if self._conn:
+                self._conn.close()
+                self._conn = None
+
+
+class HashCache(SQLiteStore):
+    """
+    文件sha1缓存，以(device, inode, size, mtime_ns)判断文件是否变化
+    """
+    _instance = None
+    _first_init = True
+    _schema = '''
+        CREATE TABLE IF NOT EXISTS hash_cache (
+            dev INTEGER NOT NULL,
+            ino INTEGER NOT NULL,
+            size INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            path TEXT NOT NULL,
+            content_hash TEXT NOT NULL,
+            PRIMARY KEY (dev, ino)
+        );
+    '''
+
+    def __new__(cls, *args, **kwargs):
+        if not cls._instance:
+            cls._instance = super().__new__(cls)
+        return cls._instance
+
+    def __init__(self, db_file=None):
+        if not self._first_init:
+            return
+        self._first_init = False
+        super(HashCache, self).__init__(db_file or Path(ROOT_DIR) / 'hash_cache.db')
+
+    def get(self, path, stat: os.stat_result = None):
+        """
+        获取缓存的sha1，文件变化时删除缓存
+        :param path:
+        :param stat: 文件状态，不指定时读取path
+        :return:
+        """
+        stat = stat or os.stat(path)
+        if not stat.st_ino:
+            return None
+        try:
+            row = self.execute('SELECT size, mtime_ns, content_hash FROM hash_cache WHERE dev = ? AND ino = ?',
+                               (stat.st_dev, stat.st_ino))
+            if not row:
+                return None
+            size, mtime_ns, content_hash = row[0]
+            if size != stat.st_size or mtime_ns != stat.st_mtime_ns:
+                self.delete(stat)
+                return None
+        except sqlite3.Error:
+            logger.warning(f'Failed to read hash cache {self._db_file}.')
+            return None
+        logger.info(f'The SHA1 of file {path} is {content_hash} (cached).')
+        return content_hash
+
+    def set(self, path, content_hash: str, stat: os.stat_result = None):
+        """
+        缓存sha1
+        :param path:
+        :param content_hash:
+        :param stat: 计算sha1之前的文件状态
+        :return:
+        """
+        stat = stat or os.stat(path)
+        if not stat.st_ino:
+            return
+        try:
+            self.execute('INSERT OR REPLACE INTO hash_cache (dev, ino, size, mtime_ns, path, content_hash) '
+                         'VALUES (?, ?, ?, ?, ?, ?)',
+                         (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns,
+                          str(Path(path).absolute()), content_hash))
+        except sqlite3.Error:
+            logger.warning(f'Failed to write hash cache {self._db_file}.')
+
+    def delete(self, stat: os.stat_result):
+        self.execute('DELETE FROM hash_cache WHERE dev = ? AND ino = ?', (stat.st_dev, stat.st_ino))
+
+    def prune(self) -> int:
+        """
+        删除已删除或已修改文件的缓存
+        :return: 删除的数量
+        """
+        stale_list = []
+        for dev, ino, size, mtime_ns, path in self.execute('SELECT dev, ino, size, mtime_ns, path FROM hash_cache'):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                stale_list.append((dev, ino))
+                continue
+            if (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns) != (dev, ino, size, mtime_ns):
+                stale_list.append((dev, ino))
+        self.executemany('DELETE FROM hash_cache WHERE dev = ? AND ino = ?', stale_list)
+        logger.info(f'Pruned {len(stale_list)} entries from hash cache.')
+        return len(stale_list)
+
+    def clear(self) -> int:
+        count = self.execute('SELECT COUNT(*) FROM hash_cache')[0][0]
+        self.execute('DELETE FROM hash_cache')
+        return count
+
+
+class TaskData(DATA):
+    """
+    断点续传任务，修改后立即写入日志
+    """
+
+    def __init__(self, journal, key, seq=None):
+        super(TaskData, self).__init__(seq)
+        object.__setattr__(self, '_journal', journal)
+        object.__setattr__(self, '_key', key)
+
+    def __setitem__(self, key, value):
+        super(TaskData, self).__setitem__(key, value)
+        if '_journal' in self.__dict__:
+            self._journal.save(self._key, self)
+
+    def __delitem__(self, key):
+        super(TaskData, self).__delitem__(key)
+        self._journal.save(self._key, self)
+
+
+class TaskJournal(SQLiteStore, MutableMapping):
+    """
+    断点续传任务日志，每次修改任务只写入该任务，按需读取
+    """
+    _instance = None
+    _first_init = True
+    _schema = '''
+        CREATE TABLE IF NOT EXISTS tasks (
+            key TEXT PRIMARY KEY,
+            data TEXT NOT NULL,
+            updated_at REAL NOT NULL
+        );
+    '''
+
+    def __new__(cls, *args, **kwargs):
+        if not cls._instance:
+            cls._instance = super().__new__(cls)
+        return cls._instance
+
+    def __init__(self, db_file=None):
+        if not self._first_init:
+            return
+        self._first_init = False
+        super(TaskJournal, self).__init__(db_file or Path(ROOT_DIR) / 'tasks.db')
+        # 已读取的任务，同一任务共用同一个对象
+        self._tasks = {}
+
+    def save(self, key: str, task: dict):
+        """
+        写入任务
+        :param key: 任务标识
+        :param task:
+        :return:
+        """
+        self.execute('INSERT OR REPLACE INTO tasks (key, data, updated_at) VALUES (?, ?, ?)',
+                     (key, json.dumps(dict(task)), time.time()))
+
+    def import_tasks(self, tasks: dict):
+        """
+        在一个事务中导入多个任务
+        :param tasks: {任务标识: 任务}
+        :return:
+        """
+        now = time.time()
+        with self._lock:
+            self.executemany('INSERT OR REPLACE INTO tasks (key, data, updated_at) VALUES (?, ?, ?)',
+                             [(key, json.dumps(dict(task)), now) for key, task in tasks.items()])
+            self._tasks.clear()
+
+    def __getitem__(self, key: str) -> TaskData:
+        with self._lock:
+            if key not in self._tasks:
+                row = self.execute('SELECT data FROM tasks WHERE key = ?', (key,))
+                if not row:
+                    raise KeyError(key)
+                self._tasks[key] = TaskData(self, key, json.loads(row[0][0]))
+            return self._tasks[key]
+
+    def __setitem__(self, key: str, value: dict):
+        with self._lock:
+            task = TaskData(self, key, value)
+            self.save(key, task)
+            self._tasks[key] = task
+
+    def __delitem__(self, key: str):
+        with self._lock:
+            self._tasks.pop(key, None)
+            self.execute('DELETE FROM tasks WHERE key = ?', (key,))
+
+    def __contains__(self, key) -> bool:
+        with self._lock:
+            return key in self._tasks or bool(self.execute('SELECT 1 FROM tasks WHERE key = ?', (key,)))
+
+    def __iter__(self):
+        return iter([row[0] for row in self.execute('SELECT key FROM tasks')])
+
+    def __len__(self) -> int:
+        return self.execute('SELECT COUNT(*) FROM tasks')[0][0]
+
+
+class UrlCache(SQLiteStore):
+    """
+    下载链接缓存，以(drive_id, file_id, category)为键，链接过期前返回缓存，超过数量时淘汰最久未使用的链接
+    """
+    _schema = '''
+        CREATE TABLE IF NOT EXISTS url_cache (
+            drive_id TEXT NOT NULL,
+            file_id TEXT NOT NULL,
+            category TEXT NOT NULL,
+            url TEXT NOT NULL,
+            expire_time REAL NOT NULL,
+            PRIMARY KEY (drive_id, file_id, category)
+        );
+    '''
+
+    def __init__(self, db_file=None, max_size: int = 10000, margin: float = 300):
+        """
+        :param db_file: 保存到本地的数据库，不指定时只缓存在内存
+        :param max_size: 最多缓存的链接数
+        :param margin: 距离过期不足margin秒的链接视为已过期
+        """
+        super(UrlCache, self).__init__(db_file)
+        self._max_size = max_size
+        self._margin = margin
+        self._cache = OrderedDict()
+        self._loaded = not db_file
+
+    max_size = property(lambda self: self._max_size)
+    margin = property(lambda self: self._margin)
+
+    def __len__(self):
+        return len(self._cache)
+
+    def _load(self):
+        if self._loaded:
+            return
+        self._loaded = True
+        now = time.time()
+        try:
+            self.execute('DELETE FROM url_cache WHERE expire_time < ?', (now + self._margin,))
+            rows = self.execute('SELECT drive_id, file_id, category, url, expire_time FROM url_cache '
+                                'ORDER BY expire_time DESC LIMIT ?', (self._max_size,))
+        except sqlite3.Error:
+            logger.warning(f'Failed to read url cache {self._db_file}.')
+            return
+        for drive_id, file_id, category, url, expire_time in reversed(rows):
+            self._cache[(drive_id, file_id, category)] = (url, expire_time)
+
+    def get(self, key: tuple, lifetime: float = 0):
+        """
+        获取未过期的链接
+        :param key: (drive_id, file_id, category)
+        :param lifetime: 链接至少还需有效的时间（秒），允许相差margin秒
+        :return:
+        """
+        with self._lock:
+            self._load()
+            if key not in self._cache:
+                return None
+            url, expire_time = self._cache[key]
+            remaining = expire_time - time.time()
+            if remaining < self._margin:
+                self.delete(key)
+                return None
+            if remaining < lifetime - self._margin:
+                return None
+            self._cache.move_to_end(key)
+            return url
+
+    def set(self, key: tuple, url: str, expire_time: float):
+        """
+        缓存链接
+        :param key: (drive_id, file_id, category)
+        :param url:
+        :param expire_time: 过期时间戳
+        :return:
+        """
+        with self._lock:
+            self._load()
+            self._cache[key] = (url, expire_time)
+            self._cache.move_to_end(key)
+            evicted_list = []
+            while len(self._cache) > self._max_size:
+                evicted_list.append(self._cache.popitem(last=False)[0])
+            if not self._db_file:
+                return
+            try:
+                self.execute('INSERT OR REPLACE INTO url_cache (drive_id, file_id, category, url, expire_time) '
+                             'VALUES (?, ?, ?, ?, ?)', (*key, url, expire_time))
+                if evicted_list:
+                    self.executemany('DELETE FROM url_cache WHERE drive_id = ? AND file_id = ? AND category = ?',
+                                     evicted_list)
+            except sqlite3.Error:
+                logger.warning(f'Failed to write url cache {self._db_file}.')
+
+    def delete(self, key: tuple):
+        with self._lock:
+            self._cache.pop(key, None)
+            if self._db_file:
+                self.execute('DELETE FROM url_cache WHERE drive_id = ? AND file_id = ? AND category = ?', key)
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+            if self._db_file:
+                self.execute('DELETE FROM url_cache')
+
+
+class Aria2Tasks(SQLiteStore):
+    """
+    发送到aria2的下载任务，以gid为键，下载链接过期导致失败时用于重新添加
+    """
+    _instance = None
+    _first_init = True
+    _schema = '''
+        CREATE TABLE IF NOT EXISTS aria2_tasks (
+            gid TEXT PRIMARY KEY,
+            file_id TEXT NOT NULL,
+            options TEXT NOT NULL,
+            added_at REAL NOT NULL
+        );
+    '''
+
+    def __new__(cls, *args, **kwargs):
+        if not cls._instance:
+            cls._instance = super().__new__(cls)
+        return cls._instance
+
+    def __init__(self, db_file=None):
+        if not self._first_init:
+            return
+        self._first_init = False
+        super(Aria2Tasks, self).__init__(db_file or Path(ROOT_DIR) / 'aria2_tasks.db')
+
+    def __len__(self):
+        return self.execute('SELECT COUNT(*) FROM aria2_tasks')[0][0]
+
+    def add(self, task_list: list):
+        """
+        记录任务
+        :param task_list: [(gid, file_id, aria2参数)]
+        :return:
+        """
+        now = time.time()
+        self.executemany('INSERT OR REPLACE INTO aria2_tasks (gid, file_id, options, added_at) VALUES (?, ?, ?, ?)',
+                         [(gid, file_id, json.dumps(options), now) for gid, file_id, options in task_list])
+
+    def items(self) -> list:
+        """
+        :return: [(gid, file_id, aria2参数)]
+        """
+        return [(gid, file_id, json.loads(options)) for gid, file_id, options in
+                self.execute('SELECT gid, file_id, options FROM aria2_tasks ORDER BY added_at')]
+
+    def delete(self, gid_list: list):
+        self.executemany('DELETE FROM aria2_tasks WHERE gid = ?', [(gid,) for gid in gid_list])
+
+
+class MetaCache(SQLiteStore):
+    """
+    云盘文件元数据缓存，保存每个文件夹最近一次获取的文件列表，超过ttl或文件夹的updated_at变化后重新获取
+    """
+    _schema = '''
+        CREATE TABLE IF NOT EXISTS files (
+            drive_id TEXT NOT NULL,
+            file_id TEXT NOT NULL,
+            parent_id TEXT NOT NULL,
+            name TEXT NOT NULL,
+            type TEXT NOT NULL,
+            size INTEGER,
+            content_hash TEXT,
+            updated_at TEXT,
+            info TEXT NOT NULL,
+            PRIMARY KEY (drive_id, file_id)
+        );
+        CREATE INDEX IF NOT EXISTS files_parent ON files (drive_id, parent_id);
+        CREATE TABLE IF NOT EXISTS folders (
+            drive_id TEXT NOT NULL,
+            file_id TEXT NOT NULL,
+            listed_at REAL NOT NULL,
+            updated_at TEXT,
+            PRIMARY KEY (drive_id, file_id)
+        );
+        CREATE TABLE IF NOT EXISTS drives (
+            drive_id TEXT PRIMARY KEY,
+            changed_at TEXT
+        );
+    '''
+    # 会过期的字段不缓存
+    _volatile_keys = ('download_url', 'url', 'thumbnail')
+    # 允许的本地与服务器时间误差（秒）
+    _clock_skew = 600
+
+    def __init__(self, db_file=None, ttl: float = 3600):
+        """
+        :param db_file:
+        :param ttl: 文件列表的有效时间（秒）
+        """
+        super(MetaCache, self).__init__(db_file or Path(ROOT_DIR) / 'meta_cache.db')
+        self._ttl = ttl
+
+    ttl = property(lambda self: self._ttl, lambda self, value: setattr(self, '_ttl', value))
+
+    def __len__(self):
+        return self.execute('SELECT COUNT(*) FROM files')[0][0]
+
+    def get_children(self, drive_id: str, file_id: str, updated_at: str = None):
+        """
+        获取缓存的文件列表
+        :param drive_id:
+        :param file_id: 文件夹id
+        :param updated_at: 文件夹当前的updated_at，与缓存时不同则视为已过期
+        :return: 未缓存或已过期时返回None
+        """
+        try:
+            row = self.execute('SELECT listed_at, updated_at FROM folders WHERE drive_id = ? AND file_id = ?',
+                               (drive_id, file_id))
+            if not row or time.time() - row[0][0] > self._ttl:
+                return None
+            if updated_at and row[0][1] != updated_at:
+                return None
+            rows = self.execute('SELECT info FROM files WHERE drive_id = ? AND parent_id = ?', (drive_id, file_id))
+        except sqlite3.Error:
+            logger.warning(f'Failed to read meta cache {self._db_file}.')
+            return None
+        logger.info(f'Get the list of parent_file_id {file_id} (cached).')
+        return [json.loads(info) for info, in rows]
+
+    def _rows(self, drive_id, file_list, parent_id=None):
+        row_list = []
+        for info in file_list:
+            info = {k: v for k, v in info.items() if k not in self._volatile_keys}
+            row_list.append((drive_id, info['file_id'], parent_id or info['parent_file_id'], info['name'],
+                             info['type'], info.get('size'), info.get('content_hash'), info.get('updated_at'),
+                             json.dumps(info)))
+        return row_list
+
+    def set_children(self, drive_id: str, file_id: str, file_list: list, updated_at: str = None):
+        """
+        替换文件夹的文件列表
+        :param drive_id:
+        :param file_id: 文件夹id
+        :param file_list: get_file_list的返回值
+        :param updated_at: 获取列表时文件夹的updated_at
+        :return:
+        """
+        row_list = self._rows(drive_id, file_list, file_id)
+        try:
+            with self.transaction() as conn:
+                conn.execute('DELETE FROM files WHERE drive_id = ? AND parent_id = ?', (drive_id, file_id))
+                conn.executemany('INSERT OR REPLACE INTO files (drive_id, file_id, parent_id, name, type, size, '
+                                 'content_hash, updated_at, info) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', row_list)
+                conn.execute('INSERT OR REPLACE INTO folders (drive_id, file_id, listed_at, updated_at) '
+                             'VALUES (?, ?, ?, ?)', (drive_id, file_id, time.time(), updated_at))
+                # 第一次缓存文件列表时记录合并位置，留出本地与服务器的时间误差
+                conn.execute('INSERT OR IGNORE INTO drives (drive_id, changed_at) VALUES (?, ?)',
+                             (drive_id, time.strftime('%Y-%m-%dT%H:%M:%S.000Z',
+                                                      time.gmtime(time.time() - self._clock_skew))))
+        except sqlite3.Error:
+            logger.warning(f'Failed to write meta cache {self._db_file}.')
+
+    def get_changed_at(self, drive_id: str):
+        """
+        获取变更的合并位置，此后的变更可能未包含在缓存的文件列表中
+        :param drive_id:
+        :return: 未记录时返回None
+        """
+        row = self.execute('SELECT changed_at FROM drives WHERE drive_id = ?', (drive_id,))
+        return row[0][0] if row else None
+
+    def apply_changes(self, drive_id: str, file_list: list, complete=True):
+        """
+        把变更的文件合并到缓存中，已移动的文件会从原文件夹中移除
+        :param drive_id:
+        :param file_list: 变更的文件信息
+        :param complete: file_list是否包含全部变更，否则使所有文件列表失效
+        :return:
+        """
+        changed_at = max((i['updated_at'] for i in file_list if i.get('updated_at')), default=None)
+        try:
+            with self.transaction() as conn:
+                if not complete:
+                    conn.execute('DELETE FROM folders WHERE drive_id = ?', (drive_id,))
+                conn.executemany('INSERT OR REPLACE INTO files (drive_id, file_id, parent_id, name, type, size, '
+                                 'content_hash, updated_at, info) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                 self._rows(drive_id, file_list))
+                if changed_at:
+                    conn.execute('INSERT OR REPLACE INTO drives (drive_id, changed_at) VALUES (?, ?)',
+                                 (drive_id, changed_at))
+        except sqlite3.Error:
+            logger.warning(f'Failed to write meta cache {self._db_file}.')
+
+    def invalidate(self, drive_id: str, file_id: str):
+        """
+        文件夹的内容已改变，下次使用时重新获取
+        :param drive_id:
+        :param file_id: 文件夹id
+        :return:
+        """
+        self.execute('DELETE FROM folders WHERE drive_id = ? AND file_id = ?', (drive_id, file_id))
+
+    def clear(self) -> int:
+        count = self.execute('SELECT COUNT(*) FROM files')[0][0]
+        with self.transaction() as conn:
+            conn.execute('DELETE FROM files')
+            conn.execute('DELETE FROM folders')
+            conn.execute('DELETE FROM drives')
+        return count
@@ -1,19 +1,29 @@
 import base64
 import ctypes
+import errno
 import hashlib
 import inspect
+import io
 import json
 import logging
+import mmap
 import os
 import socket
 import sys
+import time
+from collections import deque
 from pathlib import Path
+from threading import Lock, Event
 
 import requests
 import rsa
 
-__all__ = ['ROOT_DIR', 'logger', 'log_file', 'get_sha1', 'str_of_size', 'Iter', 'encrypt', 'parse_biz_ext',
-           'stop_thread', 'get_open_port', 'get_real_path', 'get_proof_code', 'get_url_byte', 'get_file_byte']
+from aliyunpan.exceptions import UploadCancelled
+
+__all__ = ['ROOT_DIR', 'logger', 'log_file', 'get_sha1', 'get_file_hash', 'str_of_size', 'Iter', 'encrypt',
+           'parse_biz_ext', 'stop_thread', 'get_open_port', 'get_real_path', 'get_proof_code', 'get_proof_range',
+           'get_url_byte', 'get_file_byte', 'read_range', 'write_range', 'allocate', 'ChunkSizer',
+           'parse_size', 'RateLimiter', 'ThrottledReader', 'PartReader', 'RangeReader']
 
 ROOT_DIR = str(Path(os.environ.get('ALIYUNPAN_ROOT')).resolve().absolute()) if os.environ.get(
     'ALIYUNPAN_ROOT') else os.path.dirname(os.path.realpath(sys.argv[0]))
@@ -29,31 +39,122 @@ logging.getLogger("requests").setLevel(logging.WARNING)
 logging.getLogger("urllib3").setLevel(logging.WARNING)
 
 
+_file_lock = Lock()
+
+
 def get_sha1(path, split_size=524288):
+    with open(path, 'rb') as f:
+        return get_file_hash(f, path, split_size)[0]
+
+
+def get_file_hash(f, path, split_size=524288, proof_range=None):
+    """
+    一次读取计算sha1和proof字节
+    :param f: 已打开的文件
+    :param path: 文件路径
+    :param split_size: 每次读取的大小
+    :param proof_range: proof字节范围(start, end)
+    :return: (sha1, proof字节)
+    """
+    stat = os.fstat(f.fileno())
+    file_size = stat.st_size
+    start, end = proof_range or (0, 0)
+    from aliyunpan.api.store import HashCache
+    hash_cache = HashCache()
+    content_hash = hash_cache.get(path, stat)
+    if content_hash:
+        # 文件未变化，只读取proof字节
+        return content_hash, read_range(f, start, end - start)
     logger.info(f'Calculate sha1 of file {path}.')
-    file_size = os.path.getsize(path)
+    split_size = max(split_size, 4194304)
+    proof_bytes = b''
     from aliyunpan.common import HashBar
     hash_bar = HashBar(size=file_size)
     hash_bar.hash_info(path, size=file_size)
     hash_bar.print_line()
     hash_bar.update(refresh_line=False)
-    with open(path, 'rb') as f:
-        sha1 = hashlib.sha1()
-        count = 0
-        while True:
-            chunk = f.read(split_size)
-            k = ((count * split_size) + len(chunk)) / file_size if file_size else 0
-            hash_bar.update(ratio=k, refresh_line=True)
-            if not chunk:
-                break
-            count += 1
-            sha1.update(chunk)
-        content_hash = sha1.hexdigest()
+    sha1 = hashlib.sha1()
+    offset = 0
+    for chunk in _read_chunks(f, split_size):
+        sha1.update(chunk)
+        if start < offset + len(chunk) and offset < end:
+            proof_bytes += bytes(chunk[max(start - offset, 0):end - offset])
+        offset += len(chunk)
+        hash_bar.update(ratio=offset / file_size, refresh_line=True)
+    content_hash = sha1.hexdigest()
+    hash_cache.set(path, content_hash, stat)
     logger.info(f'The SHA1 of file {path} is {content_hash}.')
     hash_bar.refresh_line()
     hash_bar.hash_info(path, status=True, size=file_size, refresh_line=True)
     hash_bar.print_line()
-    return content_hash
+    return content_hash, proof_bytes
+
+
+def _read_chunks(f, split_size):
+    """
+    按块读取文件，优先使用mmap避免复制
+    """
+    try:
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (ValueError, OSError):
+        # 空文件或不支持mmap
+        f.seek(0)
+        read_buffer = memoryview(bytearray(split_size))
+        while True:
+            size = f.readinto(read_buffer)
+            if not size:
+                break
+            yield read_buffer[:size]
+        return
+    with buffer, memoryview(buffer) as view:
+        for offset in range(0, len(buffer), split_size):
+            with view[offset:offset + split_size] as chunk:
+                yield chunk
+
+
+def read_range(f, offset: int, size: int) -> bytes:
+    """
+    读取文件指定范围，可在多线程中共用同一个文件
+    """
+    if hasattr(os, 'pread'):
+        return os.pread(f.fileno(), size, offset)
+    with _file_lock:
+        f.seek(offset)
+        return f.read(size)
+
+
+def write_range(f, offset: int, data: bytes) -> int:
+    """
+    写入文件指定位置，可在多线程中共用同一个文件
+    """
+    if hasattr(os, 'pwrite'):
+        view = memoryview(data)
+        while view:
+            size = os.pwrite(f.fileno(), view, offset)
+            view, offset = view[size:], offset + size
+        return len(data)
+    with _file_lock:
+        f.seek(offset)
+        return f.write(data)
+
+
+def allocate(f, size: int, sparse: bool = False):
+    """
+    设置文件大小并预先分配磁盘空间，空间不足时在下载前报错
+    :param f:
+    :param size:
+    :param sparse: 只设置文件大小，不分配磁盘空间
+    :return:
+    """
+    f.truncate(size)
+    if sparse or not size or not hasattr(os, 'posix_fallocate'):
+        return
+    try:
+        os.posix_fallocate(f.fileno(), 0, size)
+    except OSError as e:
+        # 文件系统不支持时使用稀疏文件
+        if e.errno not in (errno.EINVAL, errno.EOPNOTSUPP, errno.ENOSYS):
+            raise
 
 
 def get_proof_code(bys: bytes) -> str:
@@ -61,13 +162,17 @@ def get_proof_code(bys: bytes) -> str:
     return proof_code
 
 
-def get_file_byte(path: Path, access_token: str = None):
+def get_proof_range(file_size: int, access_token: str = None):
     n1 = int(hashlib.md5(access_token.encode()).hexdigest()[:16], 16)
-    n2 = path.stat().st_size
+    n2 = file_size
     n3 = (n1 % n2) if n2 else 0
+    return n3, min(n3 + 8, n2)
+
+
+def get_file_byte(path: Path, access_token: str = None):
+    start, end = get_proof_range(path.stat().st_size, access_token)
     with path.open('rb') as f:
-        f.seek(n3)
-        return f.read(min(n3 + 8, n2) - n3)
+        return read_range(f, start, end - start)
 
 
 def get_url_byte(url: str, access_token: str = None, file_size: int = None):
@@ -75,10 +180,8 @@ def get_url_byte(url: str, access_token: str = None, file_size: int = None):
     req = Req()
     if not file_size:
         file_size = int(req.get(url, stream=True).headers.get('Content-Length'))
-    n1 = int(hashlib.md5(access_token.encode()).hexdigest()[:16], 16)
-    n2 = file_size
-    n3 = (n1 % n2) if n2 else 0
-    headers = {'Range': f'bytes={n3}-{min(n3 + 8, n2) - 1}'}
+    start, end = get_proof_range(file_size, access_token)
+    headers = {'Range': f'bytes={start}-{end - 1}'}
     r: requests.Response = req.get(url, headers=headers, stream=True)
     return r.content
 
@@ -98,6 +201,197 @@ def str_of_size(size, decimal=3, tuple_=False):
     return f'{size}{units[level]}'
 
 
+def parse_size(size) -> int:
+    """
+    解析带单位的大小，如 512K、10M、1.5G
+    :param size:
+    :return: 字节数
+    """
+    if not size:
+        return 0
+    if isinstance(size, (int, float)):
+        return int(size)
+    units = {'': 1, 'B': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+    size = str(size).strip().upper()
+    if size.endswith('IB'):
+        size = size[:-2]
+    elif size.endswith('B') and size[:-1] and size[-2] in units:
+        size = size[:-1]
+    number, unit = (size[:-1], size[-1]) if size[-1:] in units else (size, '')
+    try:
+        return int(float(number) * units[unit])
+    except ValueError:
+        raise ValueError(f'Invalid size: {size}')
+
+
+class RateLimiter:
+    """
+    令牌桶限速，rate为0时不限速
+    等待的线程按申请顺序获得令牌，每次申请的令牌较少时各线程平分带宽
+    """
+
+    def __init__(self, rate: int = 0, parent: 'RateLimiter' = None):
+        """
+        :param rate: 速度上限(字节/秒)
+        :param parent: 上级限速，如全局限速
+        """
+        self._rate = rate
+        self._parent = parent
+        self._tokens = 0
+        self._time = time.monotonic()
+        self._lock = Lock()
+        self._queue_lock = Lock()
+
+    rate = property(lambda self: self._rate, lambda self, value: setattr(self, '_rate', value))
+    parent = property(lambda self: self._parent)
+    limited = property(lambda self: bool(self._rate or self._parent and self._parent.rate))
+
+    def _wait(self, size: int):
+        rate = self._rate
+        if not rate:
+            return
+        with self._lock:
+            now = time.monotonic()
+            # 最多积攒1秒的令牌
+            self._tokens = min(self._tokens + (now - self._time) * rate, rate)
+            self._time = now
+            self._tokens -= size
+            wait = -self._tokens / rate
+        if wait > 0:
+            time.sleep(wait)
+
+    def consume(self, size: int):
+        """
+        申请令牌，令牌不足时等待
+        :param size: 字节数
+        :return:
+        """
+        if not (self._parent and self._parent.rate):
+            return self._wait(size)
+        # 同一文件的分块排队申请上级令牌，使多个文件平分上级带宽
+        with self._queue_lock:
+            self._wait(size)
+            self._parent.consume(size)
+
+
+class PartReader:
+    """
+    读取文件的指定范围，上传分块时按需读取，不在内存中保存整个分块
+    """
+
+    def __init__(self, f, offset: int, size: int, cancel_event: Event = None):
+        """
+        :param f: 已打开的文件，可在多线程中共用
+        :param offset: 起始位置
+        :param size: 大小
+        :param cancel_event: 设置后读取时抛出UploadCancelled，中断正在发送的请求
+        """
+        self._f = f
+        self._cancel_event = cancel_event
+        self._offset = offset
+        self._size = size
+        self._position = 0
+
+    def __len__(self):
+        return self._size
+
+    def read(self, size: int = -1) -> bytes:
+        if self._cancel_event and self._cancel_event.is_set():
+            raise UploadCancelled
+        remaining = self._size - self._position
+        if size is None or size < 0 or size > remaining:
+            size = remaining
+        if size <= 0:
+            return b''
+        data = read_range(self._f, self._offset + self._position, size)
+        self._position += len(data)
+        return data
+
+    def seek(self, offset: int, whence: int = 0) -> int:
+        if whence == 1:
+            offset += self._position
+        elif whence == 2:
+            offset += self._size
+        self._position = min(max(offset, 0), self._size)
+        return self._position
+
+    def tell(self) -> int:
+        return self._position
+
+
+class ThrottledReader:
+    """
+    限速读取，用于上传的请求体
+    """
+
+    def __init__(self, raw, size: int, limiter: RateLimiter = None):
+        """
+        :param raw: 文件对象
+        :param size: 可读取的大小
+        :param limiter:
+        """
+        self._raw = raw
+        self._size = size
+        self._limiter = limiter
+
+    def __len__(self):
+        return self._size
+
+    def read(self, size: int = -1) -> bytes:
+        data = self._raw.read(size)
+        if data and self._limiter:
+            self._limiter.consume(len(data))
+        return data
+
+    def seek(self, offset: int, whence: int = 0):
+        return self._raw.seek(offset, whence)
+
+    def tell(self) -> int:
+        return self._raw.tell()
+
+
+class RangeReader(io.RawIOBase):
+    """
+    只读取流中的指定范围，用于服务器忽略Range请求、返回整个文件的响应
+    """
+
+    def __init__(self, raw, start: int = 0, size: int = None):
+        """
+        :param raw: 从头开始读取的流
+        :param start: 范围起始位置，之前的内容读取后丢弃
+        :param size: 范围大小，为None时读到流结束
+        """
+        super(RangeReader, self).__init__()
+        self._raw = raw
+        self._skip = start
+        self._remaining = size
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        while self._skip:
+            data = self._raw.read(min(self._skip, 1048576))
+            if not data:
+                return 0
+            self._skip -= len(data)
+        view = memoryview(b).cast('B')
+        if self._remaining is not None:
+            view = view[:self._remaining]
+        if not len(view):
+            return 0
+        data = self._raw.read(len(view))
+        view[:len(data)] = data
+        if self._remaining is not None:
+            self._remaining -= len(data)
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            self._raw.close()
+        super(RangeReader, self).close()
+
+
 class Iter:
 
     def __init__(self, IterObj):
@@ -110,6 +404,79 @@ class Iter:
         return len(self.iter)
 
 
+class ChunkSizer:
+    """
+    根据文件大小和已上传分块的吞吐量、延迟选择分块大小
+    """
+
+    def __init__(self, min_size: int = 524288, max_size: int = 67108864, part_time: float = 2.0,
+                 max_part_count: int = 10000, window: int = 64):
+        """
+        :param min_size: 最小分块大小，分块大小取其整数倍
+        :param max_size: 最大分块大小，分块数超过上限时除外
+        :param part_time: 每个分块的目标上传时间(秒)
+        :param max_part_count: 分块数上限
+        :param window: 统计最近上传的分块数
+        """
+        self._min_size = min_size
+        self._max_size = max_size
+        self._part_time = part_time
+        self._max_part_count = max_part_count
+        self._samples = deque(maxlen=window)
+        self._lock = Lock()
+
+    min_size = property(lambda self: self._min_size)
+    max_size = property(lambda self: self._max_size)
+
+    def record(self, size: int, elapsed: float):
+        """
+        记录一个分块的上传耗时
+        :param size: 分块大小
+        :param elapsed: 上传耗时(秒)
+        """
+        if size > 0 and elapsed > 0:
+            with self._lock:
+                self._samples.append((size, elapsed))
+
+    def estimate(self):
+        """
+        按 耗时 = 延迟 + 大小 / 带宽 拟合最近的分块
+        :return: (单连接带宽(字节/秒), 每个请求的延迟(秒))，没有记录时返回(None, None)
+        """
+        with self._lock:
+            samples = list(self._samples)
+        if not samples:
+            return None, None
+        n = len(samples)
+        mean_size = sum(i[0] for i in samples) / n
+        mean_time = sum(i[1] for i in samples) / n
+        var_size = sum((i[0] - mean_size) ** 2 for i in samples)
+        if var_size:
+            slope = sum((i[0] - mean_size) * (i[1] - mean_time) for i in samples) / var_size
+            latency = mean_time - slope * mean_size
+            if slope > 0 and latency >= 0:
+                return 1 / slope, latency
+        # 分块大小相同时无法区分延迟，延迟计入带宽
+        return mean_size / mean_time, 0.0
+
+    def get_chunk_size(self, file_size: int) -> int:
+        """
+        获取分块大小
+        :param file_size: 文件大小
+        :return:
+        """
+        bandwidth, latency = self.estimate()
+        if bandwidth:
+            # 分块上传时间不少于延迟的9倍，使请求开销不超过10%
+            chunk_size = min(bandwidth * max(self._part_time, latency * 9), self._max_size)
+        else:
+            # 还没有上传记录时按文件大小，分块数不超过1000
+            chunk_size = min(file_size / 1000, self._min_size * 16)
+        chunk_size = min(chunk_size, max(file_size, 1))
+        chunk_size = max(chunk_size, file_size / self._max_part_count)
+        return max(int(-(-chunk_size // self._min_size)), 1) * self._min_size
+
+
 # RSA encrypt
 PUBLIC_KEY = b'-----BEGIN PUBLIC KEY-----\n' \
              b'MIGfMA0GCSqGSIb3DQEBAQUAA4GNADCBiQKBgQDTvO8fAEJPMmHIkyP6jN+hK7rE\n' \
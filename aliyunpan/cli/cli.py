@@ -1,8 +1,11 @@
 import functools
+import io
 import os
 import platform
 import re
 import shutil
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from threading import Event
 from typing import List, Union
 
 import aria2p
@@ -10,19 +13,24 @@ import requests
 from aria2p import Options
 
 from aliyunpan.api.core import AliyunPan
+from aliyunpan.api.download import Downloader, DownloadScheduler
 from aliyunpan.api.models import *
 from aliyunpan.api.req import *
+from aliyunpan.api.store import HashCache, TaskJournal, UrlCache, Aria2Tasks, MetaCache
 from aliyunpan.api.type import Share
 from aliyunpan.api.utils import *
 from aliyunpan.cli.config import Config
 from aliyunpan.common import *
 from aliyunpan.exceptions import InvalidRefreshToken, InvalidPassword, InvalidConfiguration, \
-    ConfigurationFileNotFoundError, AliyunpanCode
+    ConfigurationFileNotFoundError, AliyunpanCode, DownloadFailed, Aria2NotConfigured
 
 __all__ = ['Commander']
 
 
 class Commander:
+    # aria2因下载链接过期失败时的错误码
+    _aria2_expired_codes = ('22', '24')
+
     def __init__(self, init=True, *args, **kwargs):
         self.match = False
         self.whitelist = False
@@ -35,16 +43,22 @@ class Commander:
         self._print = Printer()
         self._host_url = 'https://www.aliyundrive.com/'
         self._aria2 = None
+        self._download_scheduler = DownloadScheduler()
+        self._aria2_tasks = Aria2Tasks()
         self.filter_set = set()
         self._config_set = {'~/.config/aliyunpan.yaml', '.config/aliyunpan.yaml', '~/aliyunpan.yaml', 'aliyunpan.yaml',
                             os.environ.get('ALIYUNPAN_CONF', '')}
-        GLOBAL_VAR.tasks = self._task_config.read()
+        GLOBAL_VAR.tasks = TaskJournal()
+        # 导入旧版tasks.yaml
+        tasks = self._task_config.read()
+        if tasks:
+            GLOBAL_VAR.tasks.import_tasks(tasks)
+            self._task_config.write({})
         GLOBAL_VAR.txt = ''
         if init:
             self.init(*args, **kwargs)
 
     def __del__(self):
-        self._task_config.write(GLOBAL_VAR.tasks)
         if self._disk.refresh_token:
             try:
                 self._config.update('refresh_token', self._disk.refresh_token)
@@ -69,6 +83,14 @@ class Commander:
             self._config.config_file = get_real_path(config_file)
         elif config_file_list and config_file_list[0]:
             self._config.config_file = config_file_list[0]
+        if self._config.config_file:
+            self._disk.upload_rate = self._config.get('upload_limit_rate')
+            self._disk.file_upload_rate = self._config.get('upload_file_limit_rate')
+            self._download_scheduler.rate = self._config.get('download_limit_rate')
+            if self._config.get('url_cache'):
+                self._disk.url_cache = UrlCache(ROOT_DIR / Path('url_cache.db'))
+            if self._config.get('meta_cache'):
+                self._path_list.meta_cache = MetaCache(ttl=self._config.get('meta_cache_ttl') or 3600)
         if self._config.config_file and self._config.get('aria2'):
             aria2 = self._config.get('aria2')
         else:
@@ -100,6 +122,131 @@ class Commander:
         else:
             raise ConfigurationFileNotFoundError
 
+    @property
+    def _aria2_client(self) -> aria2p.Client:
+        if not self._aria2:
+            raise Aria2NotConfigured
+        return self._aria2.client
+
+    def _check_aria2(self) -> bool:
+        """
+        检查是否已配置aria2，未配置时输出错误信息
+        """
+        if self._aria2:
+            return True
+        self._print.print_info(str(Aria2NotConfigured()), error=True)
+        self._print.print_line()
+        return False
+
+    def aria2_limit(self) -> dict:
+        """
+        按总速度上限计算每个aria2任务的限速，不修改aria2的全局设置
+        :return: aria2参数
+        """
+        rate = self._download_scheduler.rate
+        if not rate:
+            return {}
+        # aria2同时下载的任务平分总速度
+        if not self._aria2:
+            raise Aria2NotConfigured
+        jobs = self._aria2.get_global_options().max_concurrent_downloads or 5
+        return {'max-download-limit': str(max(rate // jobs, 1))}
+
+    @staticmethod
+    def get_priority(path, priority=0) -> int:
+        """
+        获取下载任务的优先级
+        :param path: 本地路径
+        :param priority: 整数时对所有文件生效，或规则列表，如['\\.mp4$=10', '-1']，使用第一条匹配路径的规则
+        :return:
+        """
+        if isinstance(priority, int):
+            return priority
+        for rule in priority or ():
+            pattern, _, value = str(rule).rpartition('=')
+            if not pattern or re.search(pattern, Path(path).as_posix()):
+                return int(value)
+        return 0
+
+    def aria2_add(self, download_list, priority=0, refresh=False, batch_size=1000, **kwargs):
+        """
+        批量发送到aria2，批量获取下载链接后通过system.multicall分批添加，并记录返回的gid
+        :param download_list: [(file_id, 本地路径)]
+        :param priority: 见get_priority，优先级大于0的任务按优先级插入到aria2队列的开头
+        :param refresh: 不使用缓存的下载链接
+        :param batch_size: 每次multicall添加的任务数
+        :param kwargs: aria2参数
+        :return: {本地路径: gid}，添加失败的gid为None
+        """
+        kwargs.setdefault('referer', self._host_url)
+        for k, v in self.aria2_limit().items():
+            kwargs.setdefault(k, v)
+        download_list = sorted(download_list, key=lambda x: -self.get_priority(x[1], priority))
+        url_dict = self._disk.get_download_urls([file_id for file_id, path in download_list], refresh=refresh)
+        client = self._aria2_client
+        gid_dict = {}
+        for i in range(0, len(download_list), batch_size):
+            task_list = []
+            for j, (file_id, path) in enumerate(download_list[i:i + batch_size], i):
+                options = Options(self._aria2, {**kwargs, 'dir': str(Path(path).parent.absolute()),
+                                                'out': Path(path).name}).get_struct()
+                task_list.append((file_id, path, options, j if self.get_priority(path, priority) > 0 else None))
+            result_list = client.multicall2([(client.ADD_URI, [[url_dict[file_id]], options, position])
+                                             for file_id, path, options, position in task_list])
+            added_list = []
+            for (file_id, path, options, position), result in zip(task_list, result_list):
+                # 失败时返回包含code和message的字典
+                if isinstance(result, dict):
+                    logger.error(f'Failed to add {path} to aria2: {result}')
+                    gid_dict[path] = None
+                    continue
+                gid_dict[path] = result[0]
+                added_list.append((result[0], file_id, options))
+            self._aria2_tasks.add(added_list)
+        return gid_dict
+
+    def aria2_requeue(self, batch_size=1000) -> int:
+        """
+        检查记录的aria2任务，不再记录已结束的任务，下载链接过期而失败的任务获取新链接后重新添加
+        :param batch_size: 每次multicall查询的任务数
+        :return: 重新添加的任务数
+        """
+        task_list = self._aria2_tasks.items()
+        if not task_list:
+            return 0
+        client = self._aria2_client
+        done_list = []
+        expired_list = []
+        for i in range(0, len(task_list), batch_size):
+            chunk = task_list[i:i + batch_size]
+            result_list = client.multicall2([(client.TELL_STATUS, [gid, ['status', 'errorCode']])
+                                             for gid, file_id, options in chunk])
+            for (gid, file_id, options), result in zip(chunk, result_list):
+                # 任务已被aria2清除
+                if isinstance(result, dict):
+                    done_list.append(gid)
+                    continue
+                status = result[0]
+                if status['status'] == 'error' and status.get('errorCode') in self._aria2_expired_codes:
+                    expired_list.append((gid, file_id, options))
+                elif status['status'] in ('complete', 'removed', 'error'):
+                    done_list.append(gid)
+        self._aria2_tasks.delete(done_list + [gid for gid, file_id, options in expired_list])
+        if not expired_list:
+            return 0
+        logger.info(f'Requeue {len(expired_list)} aria2 tasks with expired download links.')
+        for i in range(0, len(expired_list), batch_size):
+            client.multicall2([(client.REMOVE_DOWNLOAD_RESULT, [gid])
+                               for gid, file_id, options in expired_list[i:i + batch_size]])
+        url_dict = self._disk.get_download_urls([file_id for gid, file_id, options in expired_list], refresh=True)
+        for i in range(0, len(expired_list), batch_size):
+            chunk = expired_list[i:i + batch_size]
+            result_list = client.multicall2([(client.ADD_URI, [[url_dict[file_id]], options])
+                                             for gid, file_id, options in chunk])
+            self._aria2_tasks.add([(result[0], file_id, options) for (gid, file_id, options), result in
+                                   zip(chunk, result_list) if not isinstance(result, dict)])
+        return len(expired_list)
+
     def aria2_init(self, **kwargs):
         kwargs.setdefault('host', 'http://localhost')
         kwargs.setdefault('port', 6800)
@@ -113,19 +260,20 @@ class Commander:
 
     def ls(self, path='root', l=False, query=None):
         if query:
-            file_info_list = self._path_list.get_file_info(self._disk.search(query))
+            # 搜索结果逐页输出
+            file_info_list = (self._path_list.get_file_info(i)[0] for i in self._disk.iter_search(query))
         else:
             file_info_list = self._path_list.get_path_list(path, update=False)
         if self.filter_set:
-            file_info_list = [i for i in file_info_list if self.file_filter(i.name)]
+            file_info_list = (i for i in file_info_list if self.file_filter(i.name))
         for i, j in enumerate(file_info_list):
             if l:
+                if i:
+                    print()
                 if j.type:
                     print(str_of_size(j.size), time.strftime('%d %b %H:%M', j.ctime), j.id, j.name, end='')
                 else:
                     print('-', time.strftime('%d %b %H:%M', j.ctime), j.id, j.name, end='')
-                if i + 1 < len(file_info_list):
-                    print()
             else:
                 print(j.name, end='\t')
         if platform.system() != 'Windows':
@@ -150,7 +298,10 @@ class Commander:
             if file_id_ == file_id:
                 file_id = file_id_
                 self._print.remove_info(path or file_id, status=True)
+                parent_node = self._path_list._tree.parent(file_id)
                 self._path_list._tree.remove_node(file_id)
+                if parent_node:
+                    self._path_list.invalidate(parent_node.identifier)
                 self._print.print_line()
             else:
                 file_id = False
@@ -195,7 +346,11 @@ class Commander:
                 _ = self._disk.move_file(file_id, target_file_id)
                 if _ and file_id:
                     self._print.move_info(path, target_path, status=True)
+                    parent_node = self._path_list._tree.parent(file_id)
                     self._path_list._tree.remove_node(file_id)
+                    if parent_node:
+                        self._path_list.invalidate(parent_node.identifier)
+                    self._path_list.invalidate(target_file_id)
                     self._path_list.update_path_list(Path(target_path) / path, is_fid=False)
                 else:
                     self._print.move_info(path, target_path, status=False)
@@ -231,6 +386,7 @@ class Commander:
             self._print.print_line()
             self._path_list._tree.create_node(tag=name, identifier=file_id, parent=parent_file_id,
                                               data=FileInfo(name=name, type=False, id=file_id, pid=parent_file_id))
+            self._path_list.invalidate(parent_file_id)
             file_id_list.append((file_id, path))
         return file_id_list
 
@@ -249,7 +405,12 @@ class Commander:
         return not whitelist
 
     def upload(self, path, upload_path='root', timeout=10.0, retry=3, force=False, share=False, chunk_size=None,
-               c=False, ignore=False):
+               c=False, ignore=False, workers=1, jobs=1, pre_hash=False, stream_hash=False, limit_rate=None,
+               file_limit_rate=None):
+        if limit_rate is not None:
+            self._disk.upload_rate = limit_rate
+        if file_limit_rate is not None:
+            self._disk.file_upload_rate = file_limit_rate
         if isinstance(path, (str, AliyunpanPath, Path)):
             path_list = {path}
         else:
@@ -280,9 +441,10 @@ class Commander:
                         path_ = share_info.name
                     else:
                         path_ = share_info.path / share_info.name
-                    for line in self.cat(path_).split('\n'):
-                        if line.startswith(self._share_link):
-                            share_list.append(parse_share_url(line, self._disk.access_token))
+                    with self.cat(path_) as f:
+                        for line in f:
+                            if line.startswith(self._share_link):
+                                share_list.append(parse_share_url(line.rstrip('\r\n'), self._disk.access_token))
                     self.rm(path_)
                     if str(upload_path) == 'root':
                         upload_path = share_info.path
@@ -311,46 +473,22 @@ class Commander:
                         result = self._disk.upload_file(
                             parent_file_id=parent_file_id, path=str(path),
                             upload_timeout=timeout, retry_num=retry, force=force, chunk_size=chunk_size, c=c,
-                            ignore=ignore)
+                            ignore=ignore, workers=workers, pre_hash=pre_hash, stream_hash=stream_hash)
                     except KeyboardInterrupt:
                         self.__del__()
                         raise
                     if result:
-                        if isinstance(result, str):
-                            file_id = result
-                        else:
-                            file_info = self._path_list.get_file_info(result)[0]
-                            file_id = file_info.id
-                            self._path_list._tree.create_node(tag=file_info.name, identifier=file_info.id,
-                                                              parent=parent_file_id, data=file_info)
-                        result_list.append(file_id)
+                        result_list.append(self._add_upload_result(result, parent_file_id))
             elif path.is_dir():
                 if upload_path == 'root':
                     upload_path = '/'
                 upload_path = Path(upload_path)
                 upload_file_list = self.upload_dir(path, upload_path)
                 upload_file_list = [i for i in upload_file_list if self.file_filter(i[1])]
-                for file in upload_file_list:
-                    try:
-                        parent_file_id = self._path_list.get_path_fid(file[0], update=False)
-                        if not parent_file_id:
-                            raise FileNotFoundError(upload_path)
-                        result = self._disk.upload_file(
-                            parent_file_id=parent_file_id, path=file[1],
-                            upload_timeout=timeout, retry_num=retry, force=force, chunk_size=chunk_size, c=c,
-                            ignore=ignore)
-                    except KeyboardInterrupt:
-                        self.__del__()
-                        raise
-                    if result:
-                        if isinstance(result, str):
-                            file_id = result
-                        else:
-                            file_info = self._path_list.get_file_info(result)[0]
-                            file_id = file_info.id
-                            self._path_list._tree.create_node(tag=file_info.name, identifier=file_info.id,
-                                                              parent=parent_file_id, data=file_info)
-                        result_list.append(file_id)
+                result_list.extend(self.upload_queue(upload_file_list, jobs, upload_timeout=timeout, retry_num=retry,
+                                                     force=force, chunk_size=chunk_size, c=c, ignore=ignore,
+                                                     workers=workers, pre_hash=pre_hash,
+                                                     stream_hash=stream_hash))
             else:
                 raise FileNotFoundError
             for file_hash, path in GLOBAL_VAR.file_set:
@@ -358,14 +496,96 @@ class Commander:
                     if isinstance(GLOBAL_VAR.tasks[file_hash].path, str):
                         del GLOBAL_VAR.tasks[file_hash]
                     else:
+                        task_path_list = list(GLOBAL_VAR.tasks[file_hash].path)
                         try:
-                            GLOBAL_VAR.tasks[file_hash].path.remove(path)
+                            task_path_list.remove(path)
                         except ValueError:
                             pass
-                        if not GLOBAL_VAR.tasks[file_hash].path:
+                        if task_path_list:
+                            GLOBAL_VAR.tasks[file_hash].path = task_path_list
+                        else:
                             del GLOBAL_VAR.tasks[file_hash]
         return result_list
 
+    def upload_queue(self, upload_file_list, jobs=1, **kwargs):
+        """
+        并发上传多个文件
+        :param upload_file_list: [[上传目录, 文件路径]]
+        :param jobs: 同时上传的文件数
+        :param kwargs: upload_file参数
+        :return: 上传成功的file_id列表
+        """
+        jobs = max(jobs or 1, 1)
+        task_list = []
+        for upload_path, file in upload_file_list:
+            parent_file_id = self._path_list.get_path_fid(upload_path, update=False)
+            if not parent_file_id:
+                raise FileNotFoundError(upload_path)
+            task_list.append((parent_file_id, Path(file), Path(file).stat().st_size))
+        result_list = []
+        failed_list = []
+        queue_bar = None
+        executor = None
+        # 中断时通知所有上传中的文件停止
+        cancel_event = Event()
+
+        def upload(parent_file_id, file):
+            return self._disk.upload_file(parent_file_id=parent_file_id, path=str(file), cancel_event=cancel_event,
+                                          **kwargs)
+
+        if jobs > 1 and task_list:
+            Bar.hidden = True
+            queue_bar = QueueBar(size=sum(i[2] for i in task_list), count=len(task_list))
+            executor = ThreadPoolExecutor(max_workers=jobs)
+            future_dict = {executor.submit(upload, parent_file_id, file): (parent_file_id, file, size)
+                           for parent_file_id, file, size in task_list}
+            done_iter = ((future_dict[future], future.result) for future in as_completed(future_dict))
+        else:
+            # 单个任务在主线程中依次上传
+            future_dict = {}
+            done_iter = ((task, functools.partial(upload, *task[:2])) for task in task_list)
+        try:
+            for (parent_file_id, file, size), get_result in done_iter:
+                try:
+                    result = get_result()
+                except (KeyboardInterrupt, SystemExit):
+                    raise
+                except BaseException as e:
+                    logger.error(f'Failed to upload {file}: {e!r}')
+                    failed_list.append((file, e))
+                    result = False
+                if queue_bar:
+                    queue_bar.done(size)
+                if result:
+                    result_list.append(self._add_upload_result(result, parent_file_id))
+        except KeyboardInterrupt:
+            cancel_event.set()
+            for future in future_dict:
+                future.cancel()
+            self.__del__()
+            raise
+        finally:
+            if executor:
+                executor.shutdown(wait=False)
+            Bar.hidden = False
+        if failed_list:
+            self._print.print_line()
+            self._print.error_info(f'{len(failed_list)}/{len(task_list)} files failed to upload.')
+            self._print.print_line()
+            for file, e in failed_list:
+                self._print.print_info(f'{file}: {type(e).__name__} {e}', error=True)
+                self._print.print_line()
+        return result_list
+
+    def _add_upload_result(self, result, parent_file_id):
+        if isinstance(result, str):
+            return result
+        file_info = self._path_list.get_file_info(result)[0]
+        self._path_list._tree.create_node(tag=file_info.name, identifier=file_info.id, parent=parent_file_id,
+                                          data=file_info)
+        self._path_list.invalidate(parent_file_id)
+        return file_info.id
+
     def upload_dir(self, path, upload_path):
         upload_path = upload_path / path.name
         if not self._path_list.get_path_fid(upload_path, update=False):
@@ -419,9 +639,15 @@ class Commander:
         return folder_list, file_list
 
     def download(self, path, save_path=None, single_file=False, share=False, chunk_size=None, aria2=False,
-                 first=True, **kwargs):
+                 first=True, workers=1, jobs=1, sparse=False, limit_rate=None, priority=0, **kwargs):
         if not chunk_size:
             chunk_size = 1048576
+        if limit_rate is not None:
+            self._download_scheduler.rate = limit_rate
+        if aria2:
+            if not self._check_aria2():
+                return
+            self.aria2_requeue()
         if not save_path:
             save_path = Path().cwd()
         save_path = Path(save_path)
@@ -444,14 +670,19 @@ class Commander:
                             self._print.mkdir_info(p, status=True)
                     except FileExistsError:
                         pass
+                # 每个导入目录只列出一次，下载时使用导入文件的大小和sha1
+                for parent in {path.parent for file_id, path in file_list}:
+                    self._path_list.update_path_list(parent, depth=0, is_fid=False)
+                if aria2:
+                    self.aria2_add([(file_id, save_path / path) for file_id, path in file_list], priority, **kwargs)
+                else:
+                    url_dict = self._disk.get_download_urls([file_id for file_id, path in file_list])
+                    for file_id, path in file_list:
+                        node = self._path_list._tree.get_node(file_id) if file_id else None
+                        self.download_file(save_path / path, url_dict[file_id], chunk_size, file_id=file_id,
+                                           size=node.data.size if node else None, workers=workers,
+                                           content_hash=node.data.content_hash if node else None, sparse=sparse)
                 for file_id, path in file_list:
-                    if aria2:
-                        kwargs.update({'dir': str((save_path / path).parent.absolute()), 'out': path.name})
-                        self._aria2.add_uris([self._disk.get_download_url(file_id)], Options(self._aria2, kwargs))
-                    else:
-                        self.download_file(save_path / path, self._disk.get_download_url(file_id), chunk_size)
-                for file_id, path in file_list:
-                    self._path_list.update_path_list(path.parent, depth=0, is_fid=False)
                     try:
                         self.rm(path)
                     except FileNotFoundError:
@@ -468,8 +699,8 @@ class Commander:
                 if not node:
                     raise FileNotFoundError(path)
                 file_node = node.data
-                self._path_list.update_path_list(file_node.id)
                 if file_node.type:
+                    self._path_list.update_path_list(file_node.id)
                     single_file = True
             else:
                 file_node, path = path, path.name
@@ -478,19 +709,106 @@ class Commander:
                 if single_file:
                     p = save_path / p.name
                 if aria2:
-                    kwargs.update({'dir': str(p.parent.absolute()), 'out': p.name})
-                    self._aria2.add_uris([self._disk.get_download_url(file_node.id)], Options(self._aria2, kwargs))
-                    self._print.download_info(p, status=True, aria2=True)
+                    gid_dict = self.aria2_add([(file_node.id, p)], priority, **kwargs)
+                    self._print.download_info(p, status=bool(gid_dict[p]), aria2=True)
                 else:
                     self._print.download_info(p)
                     self._print.print_line()
-                    self.download_file(p, file_node.download_url, chunk_size)
+                    self.download_file(p, file_node.download_url, chunk_size, file_id=file_node.id,
+                                       size=file_node.size, workers=workers,
+                                       content_hash=file_node.content_hash, sparse=sparse)
                 self._print.print_line()
             else:
-                self.download(self._path_list.get_fid_list(file_node.id), save_path=save_path / p.name,
-                              chunk_size=chunk_size, aria2=aria2, first=False, **kwargs)
+                # 并发列出整个文件夹后再从文件树中收集文件
+                self._path_list.update_path_list(file_node.id, depth=float('inf'))
+                download_file_list = self.download_dir(file_node.id, save_path / p.name)
+                if aria2:
+                    gid_dict = self.aria2_add([(file_info.id, p) for p, file_info in download_file_list], priority,
+                                              **kwargs)
+                    for p, gid in gid_dict.items():
+                        self._print.download_info(p, status=bool(gid), aria2=True)
+                        self._print.print_line()
+                else:
+                    self.download_queue(download_file_list, jobs, priority, chunk_size=chunk_size, workers=workers,
+                                        sparse=sparse)
+
+    def download_dir(self, file_id, save_path):
+        """
+        从文件树中列出云盘文件夹下的所有文件，不再请求，需先用update_path_list更新整个文件夹
+        :param file_id: 文件夹id
+        :param save_path: 本地保存路径
+        :return: [[本地路径, FileInfo]]
+        """
+        download_file_list = []
+        for node in self._path_list._tree.children(file_id):
+            file_info = node.data
+            if not self.file_filter(file_info):
+                continue
+            if file_info.type:
+                download_file_list.append([save_path / file_info.name, file_info])
+            else:
+                download_file_list.extend(self.download_dir(file_info.id, save_path / file_info.name))
+        return download_file_list
 
-    def download_file(self, path, url, chunk_size=1048576):
+    def download_queue(self, download_file_list, jobs=1, priority=0, **kwargs):
+        """
+        通过下载调度并发下载多个文件
+        :param download_file_list: [[本地路径, FileInfo]]
+        :param jobs: 同时下载的文件数
+        :param priority: 见get_priority，数值大的先开始，相同时小文件先开始
+        :param kwargs: download_file参数
+        :return: 下载成功的本地路径列表
+        """
+        jobs = max(jobs or 1, 1)
+        result_list = []
+        failed_list = []
+        queue_bar = None
+        if jobs > 1 and download_file_list:
+            Bar.hidden = True
+            queue_bar = QueueBar(size=sum(i[1].size or 0 for i in download_file_list),
+                                 count=len(download_file_list))
+        self._download_scheduler.jobs = jobs
+        job_list = sorted(((self.get_priority(path, priority), path, file_info) for path, file_info in
+                           download_file_list), key=lambda x: (-x[0], x[2].size or 0))
+        future_dict = {self._download_scheduler.submit(self.download_file, path, file_info.download_url,
+                                                       file_id=file_info.id, size=file_info.size,
+                                                       content_hash=file_info.content_hash, priority=job_priority,
+                                                       **kwargs): (path, file_info)
+                       for job_priority, path, file_info in job_list}
+        try:
+            for future in as_completed(future_dict):
+                path, file_info = future_dict[future]
+                try:
+                    result = future.result()
+                except (KeyboardInterrupt, SystemExit):
+                    raise
+                except BaseException as e:
+                    logger.error(f'Failed to download {path}: {e!r}')
+                    failed_list.append((path, e))
+                    result = None
+                if queue_bar:
+                    queue_bar.done(file_info.size or 0)
+                if result:
+                    result_list.append(path)
+                elif result is False and self.file_filter(path):
+                    failed_list.append((path, None))
+        except KeyboardInterrupt:
+            for future in future_dict:
+                future.cancel()
+            raise
+        finally:
+            Bar.hidden = False
+        if failed_list:
+            self._print.print_line()
+            self._print.error_info(f'{len(failed_list)}/{len(download_file_list)} files failed to download.')
+            self._print.print_line()
+            for path, e in failed_list:
+                self._print.print_info(f'{path}: {type(e).__name__} {e}' if e else str(path), error=True)
+                self._print.print_line()
+        return result_list
+
+    def download_file(self, path, url, chunk_size=1048576, file_id=None, size=None, workers=1, content_hash=None,
+                      sparse=False):
         if not self.file_filter(path):
             return False
         try:
@@ -500,58 +818,88 @@ class Commander:
             self._print.print_line()
         except FileExistsError:
             pass
-        if path.exists():
-            temp_size = path.stat().st_size
-        else:
-            temp_size = 0
-        headers = {'Range': 'bytes=%d-' % temp_size}
+        url_getter = functools.partial(self._disk.get_download_url, file_id, refresh=True) if file_id else None
+        if not url and file_id:
+            url = self._disk.get_download_url(file_id)
+        if content_hash and url and not self._disk.is_original_url(url):
+            # 转码后的文件与原文件sha1不同，不校验
+            logger.warning(f'{path} is downloaded from a transcoded link, skip SHA1 verification.')
+            content_hash = None
+        downloader = Downloader(path, url, size=size, url_getter=url_getter, workers=workers, chunk_size=chunk_size,
+                                content_hash=content_hash, sparse=sparse,
+                                limiter=self._download_scheduler.get_limiter())
         try:
-            r = self._req.get(url, headers=headers, stream=True)
-            file_size = int(r.headers['Content-Length'])
-            if temp_size == file_size and file_size != 0:
-                self._print.print_line()
+            self._print.print_line()
+            if not downloader.download():
                 self._print.download_info(path, status=True)
                 return True
-            elif temp_size > file_size:
-                mode = 'wb'
-                temp_size = 0
-            else:
-                mode = 'ab'
-            self._print.print_line()
-            download_bar = DownloadBar(size=file_size)
-            download_bar.update(refresh_line=False)
-            with path.open(mode) as f:
-                for chunk in r.iter_content(chunk_size=chunk_size):
-                    k = temp_size / file_size
-                    download_bar.update(ratio=k, refresh_line=True)
-                    if chunk:
-                        temp_size += len(chunk)
-                        f.write(chunk)
-        except requests.exceptions.RequestException:
+        except (requests.exceptions.RequestException, DownloadFailed):
             self._print.refresh_line()
             self._print.download_info(path, status=False)
             self._print.print_line()
             return False
+        download_bar = downloader.download_bar
         self._print.download_info(path, status=True, t=download_bar.time, average_speed=download_bar.average_speed,
                                   refresh_line=True)
         self._print.print_line()
         return True
 
-    def cat(self, path, encoding='utf-8'):
+    def cat(self, path, encoding='utf-8', head=None, tail=None, byte_range=None):
+        """
+        以文本流读取云盘文件，边下载边解码
+        :param path:
+        :param encoding:
+        :param head: 只读取开头的字节数
+        :param tail: 只读取末尾的字节数
+        :param byte_range: 读取的字节范围，如100-199、100-、-100，head、tail和byte_range只能指定一个
+        :return: 文本流
+        """
+        if [head, tail, byte_range].count(None) < 2:
+            raise ValueError('head, tail and byte_range are mutually exclusive.')
+        if byte_range is not None and not re.fullmatch(r'\d+-\d*|-\d+', byte_range):
+            raise ValueError(f'Invalid byte range {byte_range!r}.')
         file_node = self._path_list.get_path_node(path, update=False)
         if not file_node:
             raise FileNotFoundError(path)
         file = file_node.data
         self._path_list.update_path_list(file.id)
-        r = self._req.get(file.download_url)
-        r.encoding = encoding
-        return r.text
+        if head is not None:
+            byte_range = f'0-{head - 1}' if head > 0 else None
+        elif tail is not None:
+            byte_range = f'-{tail}' if tail > 0 else None
+        if (head is not None or tail is not None) and not byte_range:
+            return io.StringIO()
+        headers = {'Range': f'bytes={byte_range}'} if byte_range else {}
+        r = self._req.get(self._disk.get_download_url(file.id), headers=headers, stream=True)
+        if r.status_code == AliyunpanCode.request_expired:
+            r.close()
+            r = self._req.get(self._disk.get_download_url(file.id, refresh=True), headers=headers, stream=True)
+        # 范围超出文件大小
+        if r.status_code == 416:
+            r.close()
+            return io.StringIO()
+        r.raise_for_status()
+        r.raw.decode_content = True
+        # 读完后由TextIOWrapper关闭
+        r.raw.auto_close = False
+        raw = r.raw
+        if byte_range and r.status_code == 200:
+            # 服务器忽略了Range，返回整个文件时只输出请求的范围
+            first, last = byte_range.split('-')
+            if first:
+                raw = RangeReader(raw, int(first), int(last) - int(first) + 1 if last else None)
+            elif 'Content-Length' in r.headers:
+                raw = RangeReader(raw, max(int(r.headers['Content-Length']) - int(last), 0))
+            else:
+                r.close()
+                raise requests.exceptions.RequestException('Range is not supported.')
+        return io.TextIOWrapper(io.BufferedReader(raw), encoding=encoding, errors='replace', newline='')
 
     def share(self, path, expire_sec, share_link, download_link, save):
         if not self.file_filter(path):
             return False
 
-        def share_(path, file_id, parent_file=''):
+        def get_share_file_list(path, file_id, parent_file=''):
             if path:
                 file_node = self._path_list.get_path_node(path, update=False)
                 if not file_node:
@@ -560,9 +908,17 @@ class Commander:
                 self._path_list.update_path_list(file.id)
             else:
                 file = self._path_list._tree.get_node(file_id).data
+            if file.type:
+                return [(file, parent_file)]
+            share_file_list = []
+            for i in self._path_list.get_fid_list(file.id):
+                share_file_list.extend(get_share_file_list(path=None, file_id=i.id,
+                                                           parent_file=Path(parent_file) / file.name))
+            return share_file_list
+
+        def share_(file, parent_file, url):
             if file.type:
                 share_txt = file.name.center(50, '-') + '\n'
-                url = self._disk.get_download_url(file.id, expire_sec, file.category)
                 if download_link:
                     share_txt += '下载链接'.center(50, '*') + '\n'
                     share_txt += url + '\n\n'
@@ -575,16 +931,21 @@ class Commander:
                     share_txt += f'python main.py upload "{url}"' + '\n\n'
                 print(share_txt)
                 GLOBAL_VAR.txt += share_txt
-            else:
-                for i in self._path_list.get_fid_list(file.id):
-                    share_(path=None, file_id=i.id, parent_file=Path(parent_file) / file.name)
 
         GLOBAL_VAR.txt += '*' * 50 + '\n'
         GLOBAL_VAR.txt += '项目地址: https://github.com/wxy1343/aliyunpan' + '\n'
         GLOBAL_VAR.txt += '*' * 50 + '\n\n'
         if expire_sec is None:
             expire_sec = 14400
-        share_(path, file_id=None)
+        share_file_list = get_share_file_list(path, file_id=None)
+        # 按类型批量获取下载链接
+        url_dict = {}
+        for category in {file.category for file, parent_file in share_file_list}:
+            url_dict.update(self._disk.get_download_urls(
+                [file.id for file, parent_file in share_file_list if file.category == category], expire_sec,
+                category))
+        for file, parent_file in share_file_list:
+            share_(file, parent_file, url_dict[file.id])
         if save:
             file_name = Path(path).name + f'{int(time.time())}.txt'
             with open(file_name, 'w', encoding='utf-8') as f:
@@ -618,11 +979,11 @@ class Commander:
                              first=False)
         upload_path = AliyunpanPath(upload_path)
         p = upload_path / relative_path
-        self._path_list.update_path_list(p, is_fid=False)
+        self._path_list.update_path_list(p, is_fid=False, incremental=True)
         file_id = self._path_list.get_path_fid(p, update=False)
         if not file_id:
             self.upload(path, upload_path, timeout=time_out, chunk_size=chunk_size, retry=retry)
-            self._path_list.update_path_list(p, is_fid=False)
+            self._path_list.update_path_list(p, is_fid=False, incremental=True)
             file_id = self._path_list.get_path_fid(p, update=False)
         path_ = self._path_list._tree.to_dict(file_id, with_data=True)[str(relative_path)]
         change_file_list = self._path_list.check_path_diff(path, path_['children'] if 'children' in path_ else [])
@@ -642,33 +1003,49 @@ class Commander:
             self._print.refresh_line()
             self.sync(path, upload_path, sync_time, time_out, chunk_size, retry, delete=delete, first=False)
 
-    def sync_local(self, sync_path, save_path, sync_time, chunk_size, delete, **kwargs):
+    def sync_local(self, sync_path, save_path, sync_time, chunk_size, delete, jobs=1, limit_rate=None, priority=0,
+                   **kwargs):
+        if kwargs.get('aria2') and not self._check_aria2():
+            return
         if not save_path:
             save_path = '.'
+        if limit_rate is not None:
+            self._download_scheduler.rate = limit_rate
         path = AliyunpanPath(save_path) + AliyunpanPath(sync_path)
         if not path.exists():
-            self.download(sync_path, save_path)
+            self.download(sync_path, save_path, jobs=jobs, priority=priority)
         file_id = self.path_list.get_path_fid(sync_path, update=False)
         if not file_id:
             raise FileNotFoundError(sync_path)
-        self._path_list.update_path_list(sync_path, is_fid=False)
+        self._path_list.update_path_list(sync_path, depth=float('inf'), is_fid=False, incremental=True)
         path_ = self._path_list._tree.to_dict(file_id, with_data=True)[str(AliyunpanPath(sync_path))]
         change_file_list = self._path_list.check_path_diff(path, path_['children'] if 'children' in path_ else [])
-        for path_ in change_file_list:
-            p = str(AliyunpanPath(path_) - AliyunpanPath(save_path))
-            file_node = self.path_list.get_path_node(p)
+        change_file_list = [(path_, str(AliyunpanPath(path_) - AliyunpanPath(save_path))) for path_ in change_file_list]
+        change_file_list = [(path_, p, self.path_list.get_path_node(p)) for path_, p in change_file_list]
+        download_file_list = []
+        for path_, p, file_node in change_file_list:
             if not file_node:
                 if delete:
                     Path(path_).unlink() if path_.is_file() else shutil.rmtree(path_)
                     self._print.remove_info(path_, True)
                     self._print.print_line()
+            elif file_node.data.type:
+                download_file_list.append((Path(save_path) / p, file_node.data))
             else:
-                self.download(p, str(save_path / Path(p).parent), chunk_size=chunk_size, **kwargs)
+                download_file_list.extend(self.download_dir(file_node.identifier, Path(save_path) / p))
+        # 变化的文件通过下载调度排队下载，或一次发送到aria2
+        if kwargs.get('aria2'):
+            aria2_kwargs = {k: v for k, v in kwargs.items() if k != 'aria2'}
+            self.aria2_requeue()
+            if download_file_list:
+                self.aria2_add([(file_info.id, p) for p, file_info in download_file_list], priority, **aria2_kwargs)
+        elif download_file_list:
+            self.download_queue(download_file_list, jobs, priority, chunk_size=chunk_size)
         if sync_time:
             self._print.wait_info('等待{time}秒后再次同步', t=sync_time, refresh_line=True)
             self._print.refresh_line()
             return self.sync_local(sync_path, save_path, sync_time=sync_time, chunk_size=chunk_size, delete=delete,
-                                   **kwargs)
+                                   jobs=jobs, priority=priority, **kwargs)
 
     def share_link(self, path_list, file_id_list=None, expiration=None):
         path_list = filter(self.file_filter, path_list)
@@ -681,6 +1058,32 @@ class Commander:
         else:
             raise FileNotFoundError
 
+    def hash_cache(self, clear=False):
+        hash_cache = HashCache()
+        if clear:
+            count = hash_cache.clear()
+            self._print.print_info(f'Removed {count} entries from {hash_cache.db_file}.')
+        else:
+            count = hash_cache.prune()
+            self._print.print_info(f'Pruned {count} stale entries from {hash_cache.db_file}.')
+        self._print.print_line()
+
+    def meta_cache(self, clear=False):
+        meta_cache = self._path_list.meta_cache if self._path_list.meta_cache is not None else MetaCache()
+        if clear:
+            count = meta_cache.clear()
+            self._print.print_info(f'Removed {count} entries from {meta_cache.db_file}.')
+        else:
+            self._print.print_info(f'{len(meta_cache)} entries in {meta_cache.db_file}.')
+        self._print.print_line()
+
+    def aria2_requeue_info(self):
+        if not self._check_aria2():
+            return
+        count = self.aria2_requeue()
+        self._print.print_info(f'Requeued {count} aria2 tasks, {len(self._aria2_tasks)} tasks are being tracked.')
+        self._print.print_line()
+
     def auto_refresh_token(self, refresh_time):
         print('Start to refresh token automatically.')
         while True:
@@ -318,10 +318,25 @@ class FileGrid(npyscreen.SimpleGrid):
         self.update_file_list(file_id='root')
 
     file_name = property(lambda self: self.values[self.edit_cell[0]][self.edit_cell[1]])
-    _file_info = property(lambda self: [file_info for file_info in self._file_list if file_info.name == self.file_name])
-    file_info = property(lambda self: self._file_info[0] if self._file_info else None)
+    file_info = property(lambda self: self._file_dict.get(self.file_name))
     parent_file_info = property(lambda self: self._parent_file_info)
 
+    @property
+    def _file_list(self):
+        return self._files
+
+    @_file_list.setter
+    def _file_list(self, file_list):
+        # 文件名到文件信息的索引，同名文件取第一个
+        self._files = file_list
+        self._file_dict = {}
+        for file_info in file_list:
+            self._file_dict.setdefault(file_info.name, file_info)
+
+    def add_file_info(self, file_info):
+        self._files.append(file_info)
+        self._file_dict.setdefault(file_info.name, file_info)
+
     def set_up_handlers(self):
         super(FileGrid, self).set_up_handlers()
         self.handlers.update({
@@ -543,7 +558,7 @@ class Mkdir(npyscreen.ActionPopup):
             for i in self.parentApp.file_grid.values:
                 file_list.extend(i)
             file_list.append(str(Text(self.name.value)))
-            self.parentApp.file_grid._file_list.append(self.parentApp._cli._path_list._tree.get_node(file_id).data)
+            self.parentApp.file_grid.add_file_info(self.parentApp._cli._path_list._tree.get_node(file_id).data)
             self.parentApp.file_grid.set_grid_values_from_flat_list(file_list)
 
     def on_cancel(self):
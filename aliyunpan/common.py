@@ -9,7 +9,7 @@ from colorama import Fore, Style, Back
 
 from aliyunpan.api.utils import str_of_size
 
-__all__ = ['DATA', 'GLOBAL_VAR', 'Printer', 'Bar', 'FileBar', 'UploadBar', 'DownloadBar', 'HashBar']
+__all__ = ['DATA', 'GLOBAL_VAR', 'Printer', 'Bar', 'FileBar', 'UploadBar', 'DownloadBar', 'HashBar', 'QueueBar']
 os.system('')
 
 
@@ -295,6 +295,9 @@ class Printer(OutPut):
 
 
 class Bar(Printer):
+    # 多个任务并发时隐藏单个任务的进度条
+    hidden = False
+
     def __init__(self, title=None, refresh_interval=0.3):
         super(Bar, self).__init__()
         self._title = title or self.__class__.__name__
@@ -333,7 +336,7 @@ class Bar(Printer):
             if self._ratio != ratio and average_speed is not None:
                 self._average_speed = average_speed
                 self._ratio = ratio
-        if t and time.time() - self._update_time >= self.refresh_interval:
+        if t and not self.hidden and time.time() - self._update_time >= self.refresh_interval:
             self._update_time = time.time()
             upload_info = self._format()
             self.output = Info(upload_info, refresh_line=refresh_line, color=Fore.LIGHTMAGENTA_EX)
@@ -406,3 +409,33 @@ class HashBar(FileBar):
 
     def hash_info(self, *args, **kwargs):
         super(HashBar, self).hash_info(*args, **kwargs)
+
+
+class QueueBar(FileBar):
+    """
+    多个文件并发时的总进度条
+    """
+    hidden = False
+
+    def __init__(self, size, count, title=None, *args, **kwargs):
+        super(QueueBar, self).__init__(size=size, *args, **kwargs)
+        self._title = title or self._upload_title
+        self._upload_info = '{title}{:<3s} [{}{}] {:.2%} [{done}/{count}] {:.2f}{unit}/s'
+        self._count_total = count
+        self._done = 0
+        self._done_size = 0
+        self._output = True
+        self._queue_lock = RLock()
+
+    def done(self, size=0):
+        with self._queue_lock:
+            self._done += 1
+            self._done_size += size
+            ratio = self._done_size / self._size if self._size else self._done / self._count_total
+            if self._done == self._count_total:
+                # 最后一次更新总是输出
+                self._update_time = 0
+            self.update(ratio=ratio, refresh_line=True)
+
+    def _format(self, *args, **kwargs):
+        return super(QueueBar, self)._format(done=self._done, count=self._count_total, *args, **kwargs)
@@ -52,6 +52,13 @@ class InvalidConfiguration(ConfigurationFileError):
     """无效的配置文件"""
 
 
+class Aria2NotConfigured(AliyunpanException):
+    """未配置aria2"""
+
+    def __str__(self):
+        return self.message or 'aria2 is not configured.'
+
+
 class InvalidParameter(AliyunpanException):
     """参数错误"""
 
@@ -76,6 +83,29 @@ class UploadUrlFailedRefresh(UploadUrlExpired):
     """上传链接刷新失败"""
 
 
+class DownloadUrlExpired(RequestExpired):
+    """下载链接已过期"""
+
+
+class DownloadFailed(AliyunpanException):
+    """下载失败"""
+
+
+class DownloadHashMismatch(DownloadFailed):
+    """下载文件的sha1不匹配"""
+
+
+class UploadTimeout(AliyunpanException):
+    """分块上传超时"""
+
+
+class UploadCancelled(AliyunpanException):
+    """上传已取消"""
+
+    def __str__(self):
+        return self.message or 'The upload has been cancelled.'
+
+
 class BadResponseCode(AliyunpanException):
     """错误的响应代码"""
 
@@ -108,6 +138,7 @@ class AliyunpanCode(object):
     existed = 'AlreadyExist.File'
     token_invalid = 'AccessTokenInvalid'
     invalid_content_hash = 'InvalidParameter.ContentHash'
+    pre_hash_matched = 'PreHashMatched'
     not_found_file = 'NotFound.File'
     request_expired = 403
     part_already_exist = 409
@@ -8,6 +8,15 @@ from aliyunpan.api.utils import logger
 from aliyunpan.cli.cli import Commander
 
 
+def check_priority(ctx, param, value):
+    for rule in value:
+        try:
+            int(rule.rpartition('=')[2])
+        except ValueError:
+            raise click.BadParameter(f'{rule!r} is not N or REGEX=N.')
+    return list(value)
+
+
 @click.group(cls=ClickAliasedGroup)
 @click.help_option('-h', '--help')
 @click.version_option(version=__version__)
@@ -87,12 +96,23 @@ def mv(path, target_path):
 @click.option('-s', '--share', is_flag=True, help='Specify the shared sequence file.')
 @click.option('-cs', '--chunk-size', type=click.INT, help='Chunk size(byte).')
 @click.option('-c', is_flag=True, help='Breakpoint continuation.')
-def upload(path, file, upload_path, time_out, retry, force, share, chunk_size, c):
+@click.option('-w', '--workers', type=click.INT, help='Number of chunks uploaded concurrently.', default=1,
+              show_default=True)
+@click.option('-j', '--jobs', type=click.INT, help='Number of files uploaded concurrently.', default=1,
+              show_default=True)
+@click.option('-ph', '--pre-hash', is_flag=True, help='Probe rapid upload with the hash of the first 1KB (files of 10MB or more).')
+@click.option('-sh', '--stream-hash', is_flag=True, help='Skip rapid upload and hash while uploading.')
+@click.option('-l', '--limit-rate', help='Total upload speed limit, e.g. 10M.')
+@click.option('-fl', '--file-limit-rate', help='Upload speed limit of each file, e.g. 2M.')
+def upload(path, file, upload_path, time_out, retry, force, share, chunk_size, c, workers, jobs, pre_hash,
+           stream_hash, limit_rate, file_limit_rate):
     if not path and not file:
         raise click.MissingParameter(param=click.get_current_context().command.params[2])
     else:
         path_list = set(filter(None, {*file, path}))
-    commander.upload(path_list, upload_path, time_out, retry, force, share, chunk_size, c)
+    commander.upload(path_list, upload_path, time_out, retry, force, share, chunk_size, c, workers=workers, jobs=jobs,
+                     pre_hash=pre_hash, stream_hash=stream_hash, limit_rate=limit_rate,
+                     file_limit_rate=file_limit_rate)
 
 
 @cli.command(aliases=['m'], help='Create folder.')
@@ -111,8 +131,17 @@ def mkdir(path):
 @click.option('-s', 'share', is_flag=True, help='Specify the shared sequence file')
 @click.option('-cs', '--chunk-size', type=click.INT, help='Chunk size(byte).', default=1048576, show_default=True)
 @click.option('-a', '--aria2', is_flag=True, help='Send to aria2.')
+@click.option('-w', '--workers', type=click.INT, help='Number of connections per file.', default=1,
+              show_default=True)
+@click.option('-j', '--jobs', type=click.INT, help='Number of files downloaded concurrently.', default=1,
+              show_default=True)
+@click.option('-sp', '--sparse', is_flag=True, help='Do not preallocate disk space.')
+@click.option('-l', '--limit-rate', help='Total download speed limit, e.g. 10M.')
+@click.option('-pr', '--priority', multiple=True, callback=check_priority,
+              help='Priority of files whose path matches REGEX, as REGEX=N, or N for all files. Higher starts first, '
+                   'smaller files first within the same priority.')
 @click.pass_context
-def download(ctx, path, file, save_path, share, chunk_size, aria2):
+def download(ctx, path, file, save_path, share, chunk_size, aria2, workers, jobs, sparse, limit_rate, priority):
     if not path and not file:
         raise click.MissingParameter(param=click.get_current_context().command.params[2])
     else:
@@ -123,7 +152,8 @@ def download(ctx, path, file, save_path, share, chunk_size, aria2):
             kwargs[i.split('=')[0]] = i.split('=')[1]
         else:
             kwargs[i.strip('-')] = True
-    commander.download(file_list, save_path=save_path, share=share, chunk_size=chunk_size, aria2=aria2, **kwargs)
+    commander.download(file_list, save_path=save_path, share=share, chunk_size=chunk_size, aria2=aria2,
+                       workers=workers, jobs=jobs, sparse=sparse, limit_rate=limit_rate, priority=priority, **kwargs)
 
 
 @cli.command(aliases=['t', 'show'], help='View file tree.')
@@ -163,8 +193,16 @@ def share(path, file, file_id, expire_sec, share_link, download_link, save, shar
 @click.help_option('-h', '--help')
 @click.argument('path', type=click.Path(), default='')
 @click.option('-e', '--encoding', type=click.STRING, default='utf-8', show_default=True)
-def cat(path, encoding):
-    click.echo(commander.cat(path, encoding))
+@click.option('--head', type=click.INT, help='Only output the first N bytes.')
+@click.option('--tail', type=click.INT, help='Only output the last N bytes.')
+@click.option('--range', 'byte_range', help='Only output the byte range, e.g. 100-199, 100-, -100.')
+def cat(path, encoding, head, tail, byte_range):
+    if [head, tail, byte_range].count(None) < 2:
+        raise click.UsageError('--head, --tail and --range are mutually exclusive.')
+    with commander.cat(path, encoding, head=head, tail=tail, byte_range=byte_range) as f:
+        for text in iter(lambda: f.read(65536), ''):
+            click.echo(text, nl=False)
+    click.echo()
 
 
 @cli.command(aliases=['sync'], help='Synchronize files.',
@@ -179,8 +217,14 @@ def cat(path, encoding):
 @click.option('-n', '--no-delete', is_flag=True, help='Do not delete the cloud/local files.')
 @click.option('-d', '--delete', is_flag=True, help='Allow deletion of cloud/local files.')
 @click.option('-l', '--local', is_flag=True, help='Sync cloud drive files to local.')
+@click.option('-j', '--jobs', type=click.INT, help='Number of files downloaded concurrently when syncing to local.',
+              default=1, show_default=True)
+@click.option('-lr', '--limit-rate', help='Total download speed limit when syncing to local, e.g. 10M.')
+@click.option('-pr', '--priority', multiple=True, callback=check_priority,
+              help='Priority of files whose path matches REGEX when syncing to local, as REGEX=N, or N for all files.')
 @click.pass_context
-def sync(ctx, local_path, remote_path, time_out, chunk_size, retry, sync_time, no_delete, delete, local):
+def sync(ctx, local_path, remote_path, time_out, chunk_size, retry, sync_time, no_delete, delete, local, jobs,
+         limit_rate, priority):
     kwargs = {}
     for i in ctx.args:
         if '=' in i:
@@ -188,11 +232,32 @@ def sync(ctx, local_path, remote_path, time_out, chunk_size, retry, sync_time, n
         else:
             kwargs[i.strip('-')] = True
     if local:
-        commander.sync_local(remote_path, local_path, sync_time, chunk_size, delete, **kwargs)
+        commander.sync_local(remote_path, local_path, sync_time, chunk_size, delete, jobs=jobs, limit_rate=limit_rate,
+                             priority=priority, **kwargs)
     else:
         commander.sync(local_path, remote_path, sync_time, time_out, chunk_size, retry, delete)
 
 
+@cli.command('hash-cache', aliases=['hc'], help='Prune the local file hash cache.')
+@click.help_option('-h', '--help')
+@click.option('-c', '--clear', is_flag=True, help='Remove all cached hashes.')
+def hash_cache(clear):
+    commander.hash_cache(clear)
+
+
+@cli.command('meta-cache', aliases=['mc'], help='Show or clear the local metadata cache of the cloud drive.')
+@click.help_option('-h', '--help')
+@click.option('-c', '--clear', is_flag=True, help='Remove all cached metadata.')
+def meta_cache(clear):
+    commander.meta_cache(clear)
+
+
+@cli.command('aria2-requeue', aliases=['ar'], help='Requeue aria2 downloads that failed with expired links.')
+@click.help_option('-h', '--help')
+def aria2_requeue():
+    commander.aria2_requeue_info()
+
+
 @cli.command(aliases=['tui'], help='Text-based User Interface.')
 @click.help_option('-h', '--help')
 def tui():